@@ -1,10 +1,13 @@
 from __future__ import annotations
 
-import json
 import logging
+import multiprocessing
+import os
 import pathlib
 import sys
-from collections import defaultdict
+import time
+import traceback
+from dataclasses import asdict, dataclass
 from pathlib import Path
 from typing import Optional
 
@@ -17,96 +20,39 @@ from tqdm import tqdm
 from src.dst.dataset import (
     TestDataset
 )
-from src.dst.utils import load_model, set_seed
+from src.dst.generation import (
+    Generation,
+    PrefixCache,
+    SlotTemplate,
+    VocabularyShortlist,
+    batch_generation,
+    candidate_scoring,
+    example_batch,
+    select_examples,
+    seq2seq_generation,
+    target_log_probs
+)
+from src.dst.journal import BeliefStateJournal
+from src.dst.sampler import TurnBatchSampler
+from src.dst.utils import belief_states_filename, load_model, load_tokenizer, set_seed
 
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 logger = logging.getLogger(__name__)
 
 
-def sequential_generation(args, batch, model, tokenizer):
-    # Run sequence generation for an example without generation api to control number of repeated tokens.
-    # This prevents complete decoding failure due to runtime errors when the model fails to generate <EOS>.
-    def _extend_mask(mask):
-        mask = torch.cat([mask, mask.new_ones((mask.shape[0], 1))], dim=-1)
-        return mask
-
-    def _truncate_past_key_values(
-            past_key_values: tuple[tuple[torch.Tensor]],
-            max_len: int = 1024
-    ):
-        truncated_key_values = []
-        for key, values in past_key_values:
-            truncated_key_values.append(
-                (
-                    key[..., -(max_len - 1):, :],
-                    values[..., -(max_len - 1):, :]
-                )
-            )
-        return tuple(truncated_key_values)
-
-    eos_id = tokenizer.eos_token_id
-    max_seq_len = args.max_seq_len
-    input_ids = batch['input_ids'].to(DEVICE)
-    attention_mask = batch['attention_mask'].to(DEVICE)
-    batch_size = input_ids.size(0)
-    assert batch_size == 1
-    past_key_values = None
-    repeat_token_count = 0
-    warning_emitted = False
-    for i in range(args.max_len):
-        if past_key_values:
-            input_ids_step = input_ids[:, -1].unsqueeze(-1)
-        else:
-            input_ids_step = input_ids
-        logits, past_key_values = model(
-            input_ids=input_ids_step,
-            attention_mask=attention_mask,
-            past_key_values=past_key_values,
-            use_cache=True,
-            return_dict=False
-        )
-
-        # logits: (B, T, V), T = 1 when past is passed
-        next_token_logits = logits[:, -1, :]
-        next_token = torch.argmax(next_token_logits, dim=-1)
-        if input_ids[0][0].item() == tokenizer.bos_token_id:
-            logger.warning(
-                "{}: Truncated entire context, decoding will be aborted...".format(batch["example_id"][0])
-            )
-            break
-        if i != 0 and next_token[0].item() == input_ids[0][-1].item():
-            # Token repeated
-            repeat_token_count += 1
-        else:
-            repeat_token_count = 0
-        if len(input_ids[0]) < max_seq_len:
-            input_ids = torch.cat([input_ids, next_token.unsqueeze(-1)], dim=-1)
-            attention_mask = _extend_mask(attention_mask)
-        else:
-            if not warning_emitted:
-                logger.warning("{} exceeds maximum sequence length, truncating...".format(batch["example_id"][0]))
-                warning_emitted = True
-            input_ids = torch.cat([input_ids[:, -(max_seq_len - 1):], next_token.unsqueeze(-1)], dim=1)
-            past_key_values = _truncate_past_key_values(past_key_values, max_len=max_seq_len)
-        if next_token[0].item() == eos_id:
-            break
-        if repeat_token_count == args.repeat_token_tolerance:
-            logger.warning(
-                f"Could not decode example {batch['example_id']}. "
-                f"Repeated token {tokenizer.decode(next_token)} more than {repeat_token_count} in a row!"
-            )
-            # Parser will warn if there is no <eos> so we leave it out
-            break
-    return input_ids
-
-
-def decode(args, batch, model, tokenizer):
+def decode(args, batch, model, tokenizer, prefix_cache: Optional[PrefixCache] = None,
+           template: Optional[SlotTemplate] = None, shortlist: Optional[VocabularyShortlist] = None,
+           inactive_ids: Optional[list[int]] = None) -> list[dict]:
+    """Decodes a batch. Returns the prediction of each example: the text and the ids of the output tokens (without
+    the context), why decoding stopped and the number of decoding steps. If the slot gate is enabled, the
+    probability of the `inactive_ids` target is added to the predictions of the slots it was computed for."""
     input_ids = batch['input_ids']
     batch_size, ctx_len = input_ids.size()
-    assert batch_size == 1
+    gate_probabilities = {}
     try:
         if args.generate_api == 'huggingface':
-            output = model.generate(
+            assert batch_size == 1
+            sequence = model.generate(
                 input_ids.to(DEVICE),
                 max_length=(ctx_len + args.max_len),
                 do_sample=False,
@@ -117,58 +63,332 @@ def decode(args, batch, model, tokenizer):
                 eos_token_id=tokenizer.eos_token_id,
                 pad_token_id=tokenizer.pad_token_id,
                 early_stopping=True,
-            )
+            )[0].tolist()
+            # Encoder-decoder outputs start with the decoder start token instead of the context
+            sequence = sequence[1:] if model.config.is_encoder_decoder else sequence[ctx_len:]
+            stop_reason = 'eos' if tokenizer.eos_token_id in sequence else 'max_len'
+            output = [Generation(sequence, stop_reason, len(sequence))]
         elif args.generate_api == 'custom':
-            output = sequential_generation(args, batch, model, tokenizer)
+            output = [None] * batch_size
+            if args.get('candidate_scoring', False):
+                output = score_candidates(args, batch, model, prefix_cache=prefix_cache)
+            if inactive_ids is not None:
+                gate_probabilities = gate_slots(
+                    args, batch, model, tokenizer, inactive_ids, output, prefix_cache=prefix_cache
+                )
+                if slot_gate_mode(args) == 'skip':
+                    threshold = args.get('slot_gate_threshold', 0.9)
+                    for index, probability in gate_probabilities.items():
+                        if probability >= threshold:
+                            output[index] = Generation(list(inactive_ids), 'gate', 1)
+            to_generate = [index for index, generation in enumerate(output) if generation is None]
+            if to_generate and model.config.is_encoder_decoder:
+                generated = seq2seq_generation(
+                    args, select_examples(batch, to_generate) if len(to_generate) < batch_size else batch, model,
+                    tokenizer
+                )
+                for index, generation in zip(to_generate, generated):
+                    output[index] = generation
+            elif to_generate:
+                generated = batch_generation(
+                    args, select_examples(batch, to_generate) if len(to_generate) < batch_size else batch, model,
+                    tokenizer, share_prefix=context_cache_mode(args) != 'none', prefix_cache=prefix_cache,
+                    template=template, shortlist=shortlist
+                )
+                for index, generation in zip(to_generate, generated):
+                    output[index] = generation
         else:
             raise ValueError(
                 f"Unknown generation API: {args.generate_API}. "
                 f"Only `huggingface' or `custom' options are valid."
             )
-        gen = tokenizer.decode(output[0])  # includes context fed into model
     except RuntimeError:
+        if batch_size > 1:
+            # Decode the examples one by one so that only the failing example is affected
+            return [
+                decode(
+                    args, example_batch(batch, index), model, tokenizer, template=template, shortlist=shortlist,
+                    inactive_ids=inactive_ids
+                )[0]
+                for index in range(batch_size)
+            ]
         logger.debug(
             f"Could not decode example {batch['example_id']}: ctx_len: {ctx_len}, max_len: {ctx_len + args.max_len}"
         )
-        gen = tokenizer.decode([tokenizer.bos_token_id, tokenizer.eos_token_id])
-    return gen
+        output = [Generation([tokenizer.eos_token_id], 'error', 0)]
+    predictions = [prediction(tokenizer, generation) for generation in output]
+    for index, probability in gate_probabilities.items():
+        predictions[index]['gate_probability'] = probability
+    return predictions
 
 
-def test(args, tokenizer, model):
-    dataset = TestDataset(args, tokenizer, args.dst_test_path, args.data_size)
-    sampler = SequentialSampler(dataset)
-    test_gen_dataloader = DataLoader(
-        dataset,
-        sampler=sampler,
-        batch_size=1,
-        collate_fn=dataset.collate_fn
+def prediction(tokenizer, generation: Generation) -> dict:
+    """The prediction saved in the belief states, whose text is the output up to <EOS>."""
+    token_ids = generation.token_ids
+    if tokenizer.eos_token_id in token_ids:
+        token_ids = token_ids[:token_ids.index(tokenizer.eos_token_id)]
+    return {'text': tokenizer.decode(token_ids).strip(), **asdict(generation)}
+
+
+def score_candidates(args, batch, model, prefix_cache: Optional[PrefixCache] = None) -> list[Optional[Generation]]:
+    """Picks the output of intent and categorical slot examples among their candidate targets.
+
+    Returns the output of each example that was scored and `None` for the examples which have to be generated:
+    non-categorical slots, examples for which the context plus a candidate exceeds ``max_seq_len`` and all examples of
+    non GPT-2 models.
+    """
+    output = [None] * len(batch['candidates'])
+    if 'gpt2' not in args.model_name_or_path.lower():
+        return output
+    if prefix_cache is None and context_cache_mode(args) != 'none':
+        # Share the context of the examples of the batch
+        prefix_cache = PrefixCache()
+    for index, candidates in enumerate(batch['candidates']):
+        if candidates is None:
+            continue
+        context_ids = batch['input_ids'][index][batch['attention_mask'][index].bool()].tolist()
+        if len(context_ids) + max(map(len, candidates)) > args.max_seq_len:
+            continue
+        output[index] = candidate_scoring(model, context_ids, candidates, prefix_cache=prefix_cache)
+    return output
+
+
+def gate_slots(args, batch, model, tokenizer, inactive_ids: list[int], output: list[Optional[Generation]],
+               prefix_cache: Optional[PrefixCache] = None) -> dict[int, float]:
+    """Computes the probability that each slot example which has no output yet is inactive.
+
+    The probability of the inactive target (``requested = false <SEP> value =``) under teacher forcing is computed
+    for all such examples of the batch in one forward pass, which is much cheaper than generating their outputs.
+    Examples for which the context plus the target exceeds ``max_seq_len`` are left out.
+
+    Returns
+    -------
+    probabilities
+        The probability of the inactive target of each gated example, by index in the batch.
+    """
+    contexts = {}
+    for index, slot in enumerate(batch['slot']):
+        if slot is None or output[index] is not None:
+            continue
+        context_ids = batch['input_ids'][index][batch['attention_mask'][index].bool()].tolist()
+        if len(context_ids) + len(inactive_ids) <= args.max_seq_len:
+            contexts[index] = context_ids
+    if not contexts:
+        return {}
+    share_prefix = context_cache_mode(args) != 'none'
+    if prefix_cache is None and share_prefix:
+        prefix_cache = PrefixCache()
+    log_probs = target_log_probs(
+        model, list(contexts.values()), inactive_ids, tokenizer.pad_token_id, share_prefix=share_prefix,
+        prefix_cache=prefix_cache
     )
+    return dict(zip(contexts, log_probs.exp().tolist()))
+
+
+def slot_gate_mode(args) -> str:
+    mode = args.get('slot_gate', 'none')
+    if mode not in ('none', 'record', 'skip'):
+        raise ValueError(f"Unknown slot gate mode: {mode}. Only `none', `record' or `skip' options are valid.")
+    return mode
+
+
+def context_cache_mode(args) -> str:
+    mode = args.get('context_cache', 'none')
+    # `true' was the only option before dialogue level caching was added
+    mode = {True: 'turn', False: 'none'}.get(mode, mode)
+    if mode not in ('none', 'turn', 'dialogue'):
+        raise ValueError(f"Unknown context cache mode: {mode}. Only `none', `turn' or `dialogue' options are valid.")
+    return mode
+
+
+@dataclass
+class DecodeInputs:
+    """Inputs which are the same for all the checkpoints of an experiment."""
+    dataset: TestDataset
+    # Batches are collated while decoding, so only the compact examples of the dataset are kept in memory
+    batches: DataLoader
+    template: Optional[SlotTemplate] = None
+    shortlist: Optional[VocabularyShortlist] = None
+    # Target of inactive slots, scored by the slot gate
+    inactive_ids: Optional[list[int]] = None
+
+
+def prepare_inputs(args, tokenizer) -> DecodeInputs:
+    """Creates the test dataset and the data loader of the batches to decode."""
+    if args.generate_api == 'custom' and 'gpt2' not in args.model_name_or_path.lower():
+        # The encoder-decoder loop neither shares key/values across examples nor scores or drafts outputs
+        unsupported = {
+            'context_cache': context_cache_mode(args) != 'none',
+            'speculative_tokens': args.get('speculative_tokens', 0) > 0,
+            'candidate_scoring': args.get('candidate_scoring', False),
+        }
+        for option, enabled in unsupported.items():
+            if enabled:
+                raise ValueError(f"{option} is only supported for GPT-2 models.")
+    dataset = TestDataset(args, tokenizer, args.dst_test_path, args.data_size)
+    # Batched decoding is only supported by the custom generation loop
+    batch_size = args.get('batch_size', 1) if args.generate_api == 'custom' else 1
+    if args.generate_api == 'custom' and context_cache_mode(args) != 'none':
+        if dataset.prompt_layout != 'context_first':
+            logger.warning("The context is only shared by the examples of a turn with the `context_first' layout.")
+        # Examples of a turn share the key/values of the context
+        test_gen_dataloader = DataLoader(
+            dataset,
+            batch_sampler=TurnBatchSampler(dataset.examples.turn, batch_size),
+            collate_fn=dataset.collate_fn
+        )
+    else:
+        test_gen_dataloader = DataLoader(
+            dataset,
+            sampler=SequentialSampler(dataset),
+            batch_size=batch_size,
+            collate_fn=dataset.collate_fn
+        )
+    inputs = DecodeInputs(dataset, test_gen_dataloader)
+    if dataset.task_format == 'service':
+        # These options rely on the targets of the `slot' task format
+        for option in ('template_decoding', 'vocabulary_shortlist'):
+            if args.get(option, False):
+                raise ValueError(f"{option} is not supported with the `service' task format.")
+        if slot_gate_mode(args) != 'none':
+            raise ValueError("The slot gate is not supported with the `service' task format.")
+    if args.generate_api == 'custom' and args.get('template_decoding', False):
+        if 'gpt2' not in args.model_name_or_path.lower():
+            raise ValueError("Template decoding is only supported for GPT-2 models.")
+        inputs.template = SlotTemplate(tokenizer, dataset.separators)
+    if args.generate_api == 'custom' and args.get('vocabulary_shortlist', False):
+        if 'gpt2' not in args.model_name_or_path.lower():
+            raise ValueError("The vocabulary shortlist is only supported for GPT-2 models.")
+        max_index = int(dataset.examples.choices.max(initial=0))
+        inputs.shortlist = VocabularyShortlist(tokenizer, dataset.separators, max_index=max_index)
+    if args.generate_api == 'custom' and slot_gate_mode(args) != 'none':
+        if 'gpt2' not in args.model_name_or_path.lower():
+            raise ValueError("The slot gate is only supported for GPT-2 models.")
+        inputs.inactive_ids = dataset.inactive_slot_ids()
+    return inputs
+
+
+def test(args, tokenizer, model, journal: BeliefStateJournal, inputs: Optional[DecodeInputs] = None):
+    """Decodes the test set, appending the predictions of each batch to `journal`. Examples already in the journal
+    are skipped, so an interrupted run resumes where it stopped."""
+    if inputs is None:
+        inputs = prepare_inputs(args, tokenizer)
+    prefix_cache = None
+    if args.generate_api == 'custom' and context_cache_mode(args) == 'dialogue':
+        # Carry the context key/values from one turn to the next
+        prefix_cache = PrefixCache()
+    decoded = journal.decoded()
+    if decoded:
+        logger.info(f"Resuming from {journal.path}: {len(decoded)} examples already decoded")
+    # Number of slots scored by the slot gate and skipped
+    gated, skipped = 0, 0
     model.eval()
-    collector = defaultdict(lambda: defaultdict(lambda: defaultdict(dict)))
-    with torch.no_grad():
-        iterator = enumerate(tqdm(test_gen_dataloader, desc="Test", disable=args.verbose.disable_display))
-        for step, batch in iterator:
-            dialogue_id, turn_idx = batch['example_id'][0].rsplit("_", 1)
-            bs_pred_str = decode(args, batch, model, tokenizer)
-            usr_utterance = batch['user_utterance'][0]
-            service = batch['service'][0]
-            slot = batch['slot'][0]
-            if slot is None:
-                collector[dialogue_id][turn_idx]["utterance"] = usr_utterance
-                collector[dialogue_id][turn_idx][service]["*intent*"] = bs_pred_str
-            else:
-                collector[dialogue_id][turn_idx]["utterance"] = usr_utterance
-                collector[dialogue_id][turn_idx][service][slot] = bs_pred_str
-    return dict(collector)
+    try:
+        with torch.no_grad():
+            iterator = enumerate(tqdm(inputs.batches, desc="Test", disable=args.verbose.disable_display))
+            for step, batch in iterator:
+                keys = [
+                    journal.key(example_id, service, slot)
+                    for example_id, service, slot in zip(batch['example_id'], batch['service'], batch['slot'])
+                ]
+                remaining = [index for index, key in enumerate(keys) if key not in decoded]
+                if not remaining:
+                    continue
+                if len(remaining) < len(keys):
+                    batch = select_examples(batch, remaining)
+                predictions = decode(
+                    args, batch, model, tokenizer, prefix_cache=prefix_cache, template=inputs.template,
+                    shortlist=inputs.shortlist, inactive_ids=inputs.inactive_ids
+                )
+                for predicted in predictions:
+                    if 'gate_probability' in predicted:
+                        gated += 1
+                        skipped += predicted['stop_reason'] == 'gate'
+                journal.append([
+                    {
+                        'example_id': batch['example_id'][index],
+                        'utterance': batch['user_utterance'][index],
+                        'service': batch['service'][index],
+                        'slot': batch['slot'][index],
+                        'prediction': predicted,
+                    }
+                    for index, predicted in enumerate(predictions)
+                ])
+    finally:
+        journal.close()
+    if prefix_cache is not None:
+        logger.info(
+            f"Context cache: reused {prefix_cache.reused_tokens} context tokens, "
+            f"computed {prefix_cache.computed_tokens} context tokens"
+        )
+    if gated:
+        logger.info(
+            f"Slot gate: skipped {skipped} of {gated} slots ({skipped / gated:.1%}) "
+            f"at threshold {args.get('slot_gate_threshold', 0.9)}"
+        )
+
+
+class CheckpointSweep:
+    """Decodes the checkpoints of an experiment one after the other.
+
+    The tokenizer, the test inputs and the model are created for the first checkpoint and reused for the others, only
+    the weights being swapped between checkpoints.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.tokenizer = None
+        self.model = None
+        self.inputs: Optional[DecodeInputs] = None
+        self.prepare_time = 0.0
+        # Checkpoint name, time to load the weights and time to decode
+        self.timings: list[tuple[str, float, float]] = []
+
+    def prepare(self, ckpt_path: pathlib.Path):
+        """Loads the tokenizer of a checkpoint and creates the test inputs, e.g. before forking decoding processes."""
+        self.args.checkpoint = str(ckpt_path)
+        self.tokenizer = load_tokenizer(self.args)
+        start_time = time.time()
+        self.inputs = prepare_inputs(self.args, self.tokenizer)
+        self.prepare_time = time.time() - start_time
+
+    def decode(self, ckpt_path: pathlib.Path, journal: BeliefStateJournal):
+        self.args.checkpoint = str(ckpt_path)
+        start_time = time.time()
+        _, self.tokenizer, self.model = load_model(self.args, device=DEVICE, model=self.model, tokenizer=self.tokenizer)
+        load_time = time.time() - start_time
+        if self.inputs is None:
+            start_time = time.time()
+            self.inputs = prepare_inputs(self.args, self.tokenizer)
+            self.prepare_time = time.time() - start_time
+        start_time = time.time()
+        test(self.args, self.tokenizer, self.model, journal, inputs=self.inputs)
+        decode_time = time.time() - start_time
+        self.timings.append((ckpt_path.name, load_time, decode_time))
+        logger.info(f"{ckpt_path.name}: loaded in {load_time:.3f}s, decoded in {decode_time:.3f}s")
+
+    def report(self) -> str:
+        lines = [f"Prepared test inputs in {self.prepare_time:.3f}s"]
+        lines.extend(f"{name}: load {load:.3f}s | decode {decode:.3f}s" for name, load, decode in self.timings)
+        if self.timings:
+            # The first checkpoint creates the model, the others only swap the weights
+            swaps = [load for _, load, _ in self.timings[1:]]
+            if swaps:
+                lines.append(f"Mean checkpoint switch time: {sum(swaps) / len(swaps):.3f}s")
+        return "\n".join(lines)
 
 
 def decode_checkpoint(
         args,
         ckpt_path: pathlib.Path,
-        hyp_path: pathlib.Path
-) -> Optional[dict]:
+        hyp_path: pathlib.Path,
+        sweep: Optional[CheckpointSweep] = None
+) -> bool:
     """Runs decoding for a single checkpoint.
 
+    The predictions are journalled while decoding, so a run interrupted before the belief states file is written
+    resumes from the journal when restarted.
+
     Parameters
     ---------
     args:
@@ -177,32 +397,109 @@ def decode_checkpoint(
         Absolute path to the model binary.
     hyp_path:
         Path of directory where all decoding results are saved.
+    sweep:
+        Reuses the inputs and the model of the checkpoints decoded before.
 
     Returns
     -------
-    belief_states
-        A dictionary containing the predicted belief state and the original utterances.
+    decoded
+        Whether belief states were written for at least one dialogue.
     """
     args.checkpoint = str(ckpt_path)
     # Suffix model name to path so that we can experiment with models
     this_ckpt_hyp_path = hyp_path.joinpath(ckpt_path.name)
-    if this_ckpt_hyp_path.exists():
+    output_path = this_ckpt_hyp_path.joinpath(
+        belief_states_filename(args.get('shard_index', 0), args.get('num_shards', 1))
+    )
+    journal = BeliefStateJournal(output_path.with_suffix(".jsonl"), args.get('journal_fsync_interval', 60.0))
+    if output_path.exists():
         if not args.override:
             logger.warning(
                 f"Cannot override predictions for {this_ckpt_hyp_path}, skipping decoding. "
                 f"Use --override flag to achieve this behaviour."
             )
-            return
+            return False
         else:
             logger.warning(f"Overriding predictions for {this_ckpt_hyp_path}")
+            journal.path.unlink(missing_ok=True)
     else:
         this_ckpt_hyp_path.mkdir(parents=True, exist_ok=True)
     logger.info(f"Decoding {str(ckpt_path)}. Saving dialogues and belief states to {hyp_path}")
-    _, tokenizer, model = load_model(args, device=DEVICE)
-    belief_states = test(args, tokenizer, model)
-    with open(this_ckpt_hyp_path.joinpath("belief_states.json"), "w") as f:
-        json.dump(belief_states, f, indent=4)
-    return belief_states
+    if sweep is not None:
+        sweep.decode(ckpt_path, journal)
+    else:
+        _, tokenizer, model = load_model(args, device=DEVICE)
+        test(args, tokenizer, model, journal)
+    num_dialogues = journal.finalize(output_path)
+    journal.path.unlink(missing_ok=True)
+    return num_dialogues > 0
+
+
+def decode_and_save(args, checkpoint: pathlib.Path, hyp_path: pathlib.Path, sweep: Optional[CheckpointSweep] = None):
+    model_config = OmegaConf.load(checkpoint.parent.joinpath("model_config.yaml"))
+    train_layout = model_config.train.get('prompt_layout', 'description_first')
+    if train_layout != args.get('prompt_layout', 'description_first'):
+        logger.warning(f"{checkpoint} was trained with the `{train_layout}' prompt layout!")
+    train_format = model_config.train.get('task_format', 'slot')
+    if train_format != args.get('task_format', 'slot'):
+        logger.warning(f"{checkpoint} was trained with the `{train_format}' task format!")
+    if decode_checkpoint(args, checkpoint, hyp_path, sweep=sweep):
+        decode_config = OmegaConf.create()
+        decode_config.decode = args
+        OmegaConf.save(
+            OmegaConf.merge(decode_config, model_config),
+            f=hyp_path.joinpath(checkpoint.name, "experiment_config.yaml")
+        )
+
+
+# Set before the worker processes are forked, so that they inherit the test inputs and the tokenizer
+_worker_sweep: Optional[CheckpointSweep] = None
+
+
+def _init_worker(num_threads: int):
+    # A fixed number of threads per process keeps the results independent of the load of the machine
+    torch.set_num_threads(num_threads)
+
+
+def _decode_in_worker(checkpoint: pathlib.Path, hyp_path: pathlib.Path):
+    decoded = len(_worker_sweep.timings)
+    try:
+        decode_and_save(_worker_sweep.args, checkpoint, hyp_path, sweep=_worker_sweep)
+    except Exception:
+        return checkpoint.name, traceback.format_exc(), None
+    # Nothing is timed if the checkpoint was skipped
+    timing = _worker_sweep.timings[-1] if len(_worker_sweep.timings) > decoded else None
+    return checkpoint.name, None, timing
+
+
+def decode_in_workers(args, all_checkpoints: list[pathlib.Path], hyp_path: pathlib.Path, workers: int,
+                      sweep: CheckpointSweep) -> list[tuple[str, str]]:
+    """Decodes the checkpoints with a pool of `workers` processes, each using an equal share of the CPU cores.
+
+    The test inputs are created once and inherited by the forked workers, each of which reuses its model across the
+    checkpoints it decodes. A checkpoint which fails does not stop the others.
+
+    Returns
+    -------
+    failures
+        The name of each checkpoint which could not be decoded and the error.
+    """
+    global _worker_sweep
+    sweep.prepare(all_checkpoints[0])
+    _worker_sweep = sweep
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+    logger.info(f"Decoding {len(all_checkpoints)} checkpoints with {workers} processes of {num_threads} threads")
+    failures = []
+    context = multiprocessing.get_context('fork')
+    with context.Pool(workers, initializer=_init_worker, initargs=(num_threads,)) as pool:
+        tasks = [(checkpoint, hyp_path) for checkpoint in all_checkpoints]
+        for name, error, timing in pool.starmap(_decode_in_worker, tasks, chunksize=1):
+            if error is not None:
+                failures.append((name, error))
+            elif timing is not None:
+                sweep.timings.append(timing)
+    _worker_sweep = None
+    return failures
 
 
 @click.command()
@@ -261,6 +558,29 @@ def decode_checkpoint(
     default=1,
     help="Subsample the checkpoints to speed up task-oriented evaluation as training progresses."
 )
+@click.option(
+    '-w',
+    '--workers',
+    'workers',
+    type=int,
+    default=1,
+    help="Number of processes decoding checkpoints in parallel with --all. The CPU cores are split between them."
+)
+@click.option(
+    '--shard-index',
+    'shard_index',
+    type=int,
+    default=0,
+    help="Index of the shard of the test set to decode, see --num-shards."
+)
+@click.option(
+    '--num-shards',
+    'num_shards',
+    type=int,
+    default=1,
+    help="Split the test dialogues in this many contiguous shards and only decode the one given by --shard-index. "
+         "The belief states of the shards are merged with scripts/merge.py."
+)
 def main(
         args_path: pathlib.Path,
         test_path: pathlib.Path,
@@ -270,11 +590,16 @@ def main(
         all: bool,
         override: bool,
         freq: int,
+        workers: int,
+        shard_index: int,
+        num_shards: int,
 ):
     args = OmegaConf.load(args_path)
     set_seed(args.reproduce)
     args = args.decode
     args.override = override
+    args.shard_index = shard_index
+    args.num_shards = num_shards
     experiment = args.experiment_name
     try:
         hyp_path = hyp_dir.joinpath(experiment)
@@ -293,7 +618,8 @@ def main(
         logging.StreamHandler(sys.stdout),
         logging.StreamHandler(sys.stderr),
         logging.FileHandler(
-            f'{hyp_path.joinpath(Path(__file__).stem)}.log',
+            f'{hyp_path.joinpath(Path(__file__).stem)}.log' if num_shards == 1 else
+            f'{hyp_path.joinpath(Path(__file__).stem)}.shard-{shard_index}-of-{num_shards}.log',
             mode='w' if not all else 'a',
         )
     ]
@@ -326,17 +652,19 @@ def main(
                 f"No checkpoint exists at {checkpoint}. Make sure you provide absolute path!"
             )
 
-    # Decode checkpoints sequentially
-    for checkpoint in all_checkpoints:
-        model_config = OmegaConf.load(checkpoint.parent.joinpath("model_config.yaml"))
-        belief_states = decode_checkpoint(args, checkpoint, hyp_path)
-        if belief_states:
-            decode_config = OmegaConf.create()
-            decode_config.decode = args
-            OmegaConf.save(
-                OmegaConf.merge(decode_config, model_config),
-                f=hyp_path.joinpath(checkpoint.name, "experiment_config.yaml")
-            )
+    sweep = CheckpointSweep(args)
+    if workers > 1 and len(all_checkpoints) > 1:
+        failures = decode_in_workers(args, all_checkpoints, hyp_path, workers, sweep)
+    else:
+        # Decode checkpoints sequentially
+        failures = []
+        for checkpoint in all_checkpoints:
+            decode_and_save(args, checkpoint, hyp_path, sweep=sweep)
+    logger.info(sweep.report())
+    for name, error in failures:
+        logger.error(f"Could not decode {name}:\n{error}")
+    if failures:
+        raise click.ClickException(f"{len(failures)} of {len(all_checkpoints)} checkpoints could not be decoded")
     logger.info('Done decoding!')
 
 
@@ -0,0 +1,236 @@
+from __future__ import annotations
+
+import functools
+import json
+import logging
+import os
+import pathlib
+import shutil
+import sys
+from pathlib import Path
+from typing import Callable, Optional
+
+import click
+
+from scripts.parse import parse
+from scripts.score import ALL_SERVICES, get_dataset_as_dict, get_in_domain_services, get_metrics
+from src.dst.metrics import JOINT_GOAL_ACCURACY
+from src.dst.utils import belief_states_filename
+
+logger = logging.getLogger(__name__)
+
+
+def gate_belief_states(belief_states: dict, threshold: float, inactive_text: str) -> tuple[dict, int, int, int]:
+    """Replaces the predictions of the slots whose gate probability is at least `threshold` by the inactive target, as
+    decoding with ``slot_gate: 'skip'`` at that threshold would.
+
+    Returns
+    -------
+    belief_states
+        The gated belief states.
+    skipped
+        The number of slots predicted inactive by the gate.
+    gated
+        The number of slots scored by the gate.
+    missing
+        The number of slots below the threshold which were skipped when decoding, so their decoded output is unknown.
+    """
+    skipped, gated, missing = 0, 0, 0
+    gated_belief_states = {}
+    for dialogue_id, turns in belief_states.items():
+        for turn_index, turn in turns.items():
+            gated_turn = gated_belief_states.setdefault(dialogue_id, {}).setdefault(turn_index, {})
+            for key, value in turn.items():
+                if key == "utterance":
+                    gated_turn[key] = value
+                    continue
+                gated_service = gated_turn.setdefault(key, {})
+                for slot, predicted in value.items():
+                    gated_service[slot] = predicted
+                    if not isinstance(predicted, dict) or 'gate_probability' not in predicted:
+                        continue
+                    gated += 1
+                    probability = predicted['gate_probability']
+                    if probability >= threshold:
+                        skipped += 1
+                        gated_service[slot] = {
+                            'text': inactive_text, 'stop_reason': 'gate', 'gate_probability': probability
+                        }
+                    elif predicted['stop_reason'] == 'gate':
+                        missing += 1
+    return gated_belief_states, skipped, gated, missing
+
+
+def score_gated(output_path: pathlib.Path, belief_states: dict, data: dict, separators: dict,
+                template_path: pathlib.Path, raw_data_dir: pathlib.Path, eval_set: str) -> float:
+    """Parses gated belief states into the dialogue templates copied to `output_path` and scores them, as parse.py and
+    score.py do for a checkpoint directory. The metrics are saved to metrics.json in `output_path`.
+
+    Returns
+    -------
+    jga
+        The joint goal accuracy over all services.
+    """
+    schema_path = raw_data_dir.joinpath(eval_set, "schema.json")
+    with open(schema_path, "r") as f:
+        schema = json.load(f)
+    shutil.copytree(template_path, output_path, dirs_exist_ok=True)
+    parse(schema, belief_states, str(output_path), data, separators)
+    in_domain_services = get_in_domain_services(str(schema_path), str(raw_data_dir.joinpath("train", "schema.json")))
+    dataset_ref = get_dataset_as_dict(os.path.join(raw_data_dir, eval_set, "dialogues_*.json"))
+    dataset_hyp = get_dataset_as_dict(os.path.join(output_path, "dialogues_*.json"))
+    metrics, _ = get_metrics(
+        dataset_ref, dataset_hyp, {service["service_name"]: service for service in schema}, in_domain_services
+    )
+    with open(output_path.joinpath("metrics.json"), "w") as f:
+        json.dump(metrics, f, indent=2, separators=(",", ": "), sort_keys=True)
+    return metrics[ALL_SERVICES][JOINT_GOAL_ACCURACY]
+
+
+def gate_checkpoint(checkpoint_hyp_path: pathlib.Path, thresholds: list[float], inactive_text: str,
+                    score: Optional[Callable[[pathlib.Path, dict], float]] = None, override: bool = False) -> dict:
+    """Writes the belief states of a checkpoint gated at each threshold to a ``gate-{threshold}`` subdirectory and
+    scores them with `score` (see `score_gated`), if given.
+
+    A threshold above the one used to decode with ``slot_gate: 'skip'`` would keep inactive slots which decoding at
+    that threshold would have filled, so such thresholds are rejected.
+
+    Returns
+    -------
+    report
+        The number of gated slots, the skip rate and the JGA at each threshold.
+    """
+    with open(checkpoint_hyp_path.joinpath(belief_states_filename()), "r") as f:
+        belief_states = json.load(f)
+    report = {}
+    for threshold in thresholds:
+        output_path = checkpoint_hyp_path.joinpath(f"gate-{threshold}")
+        if output_path.exists() and not override:
+            logger.warning(f"{output_path} exists, skipping. Use --override flag to achieve this behaviour.")
+            continue
+        gated_belief_states, skipped, gated, missing = gate_belief_states(belief_states, threshold, inactive_text)
+        if not gated:
+            raise click.ClickException(
+                f"No gate probabilities in {checkpoint_hyp_path}. Decode with slot_gate set to `record' or `skip'."
+            )
+        if missing:
+            raise click.ClickException(
+                f"{checkpoint_hyp_path.name}: {missing} slots were skipped when decoding but are below {threshold}, "
+                f"so their decoded output is unknown. Use thresholds up to the decoding one or decode with slot_gate "
+                f"set to `record'."
+            )
+        output_path.mkdir(exist_ok=True)
+        with open(output_path.joinpath(belief_states_filename()), "w") as f:
+            json.dump(gated_belief_states, f, indent=4)
+        shutil.copy(checkpoint_hyp_path.joinpath("experiment_config.yaml"), output_path)
+        report[threshold] = {'gated': gated, 'skipped': skipped, 'skip_rate': skipped / gated}
+        if score is not None:
+            report[threshold]['jga'] = score(output_path, gated_belief_states)
+        logger.info(f"{checkpoint_hyp_path.name} @ {threshold}: skipped {skipped} of {gated} slots")
+    return report
+
+
+@click.command()
+@click.option("--quiet", "log_level", flag_value=logging.WARNING, default=True)
+@click.option("-v", "--verbose", "log_level", flag_value=logging.INFO)
+@click.argument(
+    "hyp_paths",
+    nargs=-1,
+    required=True,
+    type=click.Path(exists=True, file_okay=False, path_type=Path),
+)
+@click.option(
+    "-t",
+    "--threshold",
+    "thresholds",
+    required=True,
+    multiple=True,
+    type=float,
+    help="Gate threshold to evaluate. Can be repeated.",
+)
+@click.option(
+    "-j",
+    "--json",
+    "data_path",
+    required=True,
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    help="Path to the JSON file containing the test data.",
+)
+@click.option(
+    "--template",
+    "template_path",
+    required=True,
+    type=click.Path(exists=True, file_okay=False, path_type=Path),
+    help="Directory containing blank dialogue templates, as for parse.py.",
+)
+@click.option(
+    "-r",
+    "--raw-data-dir",
+    "raw_data_dir",
+    required=True,
+    type=click.Path(exists=True, file_okay=False, path_type=Path),
+    help="Directory containing the dialogues and schema of each split, as for score.py.",
+)
+@click.option(
+    "-e",
+    "--eval-set",
+    "eval_set",
+    required=True,
+    type=click.Choice(["train", "dev", "test", "test-small"]),
+    help="Split the belief states were decoded for.",
+)
+@click.option(
+    '--override',
+    is_flag=True,
+    default=False,
+    help="Override previously gated results."
+)
+def main(hyp_paths: tuple[pathlib.Path, ...], thresholds: tuple[float, ...], data_path: pathlib.Path,
+         template_path: pathlib.Path, raw_data_dir: pathlib.Path, eval_set: str, override: bool, log_level: int):
+    """Simulates the slot gate of decode.py at several thresholds from belief states decoded with its probabilities.
+
+    HYP_PATHS are checkpoint hypothesis directories or directories containing them (e.g. an experiment directory). The
+    belief states gated at each threshold are parsed and scored in a gate-{threshold} subdirectory and the skip rate
+    and JGA of each threshold are saved to gate.json in the checkpoint directory.
+    """
+    logging.basicConfig(
+        handlers=[logging.StreamHandler(sys.stdout)],
+        level=log_level,
+        datefmt="%Y-%m-%d %H:%M",
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+    logger.setLevel(log_level)
+    with open(data_path, "r") as f:
+        dataset = json.load(f)
+        separators = dataset["separators"]
+    score = functools.partial(
+        score_gated, data=dataset["data"], separators=separators, template_path=template_path,
+        raw_data_dir=raw_data_dir, eval_set=eval_set
+    )
+    inactive_text = ("requested" + separators["pair"] + "false" + separators["default"] + "value" +
+                     separators["pair"]).strip()
+    filename = belief_states_filename()
+    directories = sorted({
+        path.parent for hyp_path in hyp_paths
+        for path in [*hyp_path.glob(filename), *hyp_path.glob(f"*/{filename}")]
+        if not path.parent.name.startswith("gate-")
+    })
+    if not directories:
+        raise click.ClickException(f"No {filename} found in {', '.join(map(str, hyp_paths))}")
+    for directory in directories:
+        report = gate_checkpoint(directory, sorted(thresholds), inactive_text, score=score, override=override)
+        if not report:
+            continue
+        report_path = directory.joinpath("gate.json")
+        if report_path.exists():
+            with open(report_path, "r") as f:
+                report = {**{float(threshold): stats for threshold, stats in json.load(f).items()}, **report}
+        with open(report_path, "w") as f:
+            json.dump(dict(sorted(report.items())), f, indent=4)
+        for threshold, stats in sorted(report.items()):
+            jga = f"{stats['jga']:.4f}" if 'jga' in stats else "not scored"
+            click.echo(f"{directory.name}\t{threshold}\tskip rate {stats['skip_rate']:.1%}\tJGA {jga}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import pathlib
+import sys
+from pathlib import Path
+
+import click
+
+from src.dst.utils import belief_states_filename
+
+logger = logging.getLogger(__name__)
+
+
+def merge_shards(checkpoint_hyp_path: pathlib.Path, num_shards: int, override: bool = False) -> bool:
+    """Merges the belief states decoded by the shards of a test set for one checkpoint.
+
+    The shards hold contiguous blocks of dialogues, so concatenating them in order gives the same file as decoding the
+    whole test set in one process. With ``batch_size`` above 1, the batches at the shard boundaries differ from those
+    of a single process, so in float32 or float16 nearly tied tokens may be decoded differently.
+
+    Returns
+    -------
+    merged
+        Whether the merged file was written.
+    """
+    output_path = checkpoint_hyp_path.joinpath(belief_states_filename())
+    if output_path.exists() and not override:
+        logger.warning(f"{output_path} exists, skipping. Use --override flag to achieve this behaviour.")
+        return False
+    shard_paths = [
+        checkpoint_hyp_path.joinpath(belief_states_filename(shard_index, num_shards))
+        for shard_index in range(num_shards)
+    ]
+    missing = [str(path) for path in shard_paths if not path.exists()]
+    if missing:
+        raise click.ClickException(f"Missing shards for {checkpoint_hyp_path}: {', '.join(missing)}")
+    belief_states = {}
+    for path in shard_paths:
+        with open(path, "r") as f:
+            shard = json.load(f)
+        overlap = belief_states.keys() & shard.keys()
+        if overlap:
+            raise click.ClickException(f"Dialogues decoded by several shards in {path}: {sorted(overlap)}")
+        belief_states.update(shard)
+    tmp_path = output_path.with_name(f".{output_path.name}.tmp-{os.getpid()}")
+    with open(tmp_path, "w") as f:
+        json.dump(belief_states, f, indent=4)
+    os.replace(tmp_path, output_path)
+    logger.info(f"Merged {num_shards} shards into {output_path}")
+    return True
+
+
+@click.command()
+@click.option("--quiet", "log_level", flag_value=logging.WARNING, default=True)
+@click.option("-v", "--verbose", "log_level", flag_value=logging.INFO)
+@click.argument(
+    "hyp_paths",
+    nargs=-1,
+    required=True,
+    type=click.Path(exists=True, file_okay=False, path_type=Path),
+)
+@click.option(
+    "-n",
+    "--num-shards",
+    "num_shards",
+    required=True,
+    type=int,
+    help="Number of shards the test set was decoded in.",
+)
+@click.option(
+    '--override',
+    is_flag=True,
+    default=False,
+    help="Override previously merged results."
+)
+def main(hyp_paths: tuple[pathlib.Path, ...], num_shards: int, override: bool, log_level: int):
+    """Merges the belief states of the shards decoded with decode.py --num-shards.
+
+    HYP_PATHS are checkpoint hypothesis directories or directories containing them (e.g. an experiment directory).
+    """
+    logging.basicConfig(
+        handlers=[logging.StreamHandler(sys.stdout)],
+        level=log_level,
+        datefmt="%Y-%m-%d %H:%M",
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+    logger.setLevel(log_level)
+    first_shard = belief_states_filename(0, num_shards)
+    directories = sorted({
+        path.parent for hyp_path in hyp_paths
+        for path in [*hyp_path.glob(first_shard), *hyp_path.glob(f"*/{first_shard}")]
+    })
+    if not directories:
+        raise click.ClickException(f"No {first_shard} found in {', '.join(map(str, hyp_paths))}")
+    for directory in directories:
+        merge_shards(directory, num_shards, override=override)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,12 +5,16 @@ import re
 import sys
 from argparse import ArgumentParser
 from distutils.dir_util import copy_tree
-from typing import Tuple
+from typing import Dict, List, Optional, Tuple, Union
 
 from omegaconf import OmegaConf
 
 logger = logging.getLogger(__name__)
 
+# Slot of the predictions of a whole service. Must stay equal to src.dst.dataset.SERVICE_SLOT, which is not imported
+# so that parsing does not depend on the training dependencies
+SERVICE_SLOT = "*service*"
+
 
 def extract_intent(
         schema: dict,
@@ -69,6 +73,102 @@ def parse_predicted_slot_string(
     return requested, value
 
 
+def parse_predicted_service_string(
+        dialogue_id: str,
+        i: str,
+        predicted_str: str,
+        separators: dict,
+        data_turn: dict,
+        service_name: str
+) -> Tuple[str, List[str], Dict[str, str]]:
+    pair = separators["pair"].strip()
+    default = separators["default"].strip()
+    slot_mapping = data_turn["service_dict"][service_name]["slot_mapping"]
+    slot_names = {str(index): slot_name for slot_name, index in slot_mapping.items()}
+    intent_names = {
+        str(index): intent_name for intent_name, index in data_turn["intent_dict"][service_name]["mapping"].items()
+    }
+
+    # Expect "intent = index <SEP> requested = slot slot ... <SEP> slot = value <SEP> ..."
+    output = [part.split(pair, 1) for part in predicted_str.split(default)]
+    if len(output) < 2 or any(len(part) != 2 for part in output) or output[0][0].strip() != "intent" or \
+            output[1][0].strip() != "requested":
+        # String was not in expected format
+        logger.warning(f"Could not parse predicted string {predicted_str} in {dialogue_id}_{i}.")
+        # Default to "NONE" and an empty state
+        return "NONE", [], {}
+    active_intent = intent_names.get(output[0][1].strip(), "NONE")
+
+    requested_slots = []
+    for index in output[1][1].split():
+        if index in slot_names:
+            requested_slots.append(slot_names[index])
+        else:
+            logger.warning(f"Unknown requested slot {index} in {dialogue_id}_{i}.")
+
+    slot_values = {}
+    for index, value in output[2:]:
+        index, value = index.strip(), value.strip()
+        if index not in slot_names:
+            logger.warning(f"Unknown slot {index} in {dialogue_id}_{i}.")
+            continue
+        slot_name = slot_names[index]
+        # Check if categorical and if value was one of available categorical slots
+        for cat_value, value_index in data_turn["slot_dict"][service_name][slot_name]["mapping"].items():
+            if str(value_index) == value:
+                value = cat_value
+                break
+        if value:
+            slot_values[slot_name] = value
+
+    return active_intent, requested_slots, slot_values
+
+
+def predicted_output_string(
+        prediction: Union[dict, str],
+        template_turn: dict,
+        dialogue_id: str,
+        i: str,
+        model_name: str
+) -> Optional[str]:
+    """Returns the output predicted for an example, or `None` if decoding did not finish.
+
+    Predictions hold the output text and why decoding stopped. Belief states decoded before predictions were
+    structured hold the decoded sequence instead, context included for GPT-2 models, from which the output is
+    extracted.
+    """
+    if isinstance(prediction, dict):
+        # Examples which could not be decoded are skipped, as are outputs which do not end with <EOS>
+        if prediction["stop_reason"] == "error":
+            logger.warning(f"Decoding failed for {dialogue_id}_{i}. Skipping.")
+            return
+        if prediction["stop_reason"] not in ("eos", "candidate", "gate"):
+            logger.warning(f"No <EOS> token in {dialogue_id}_{i}. Skipping.")
+            return
+        return prediction["text"]
+    predicted_str = prediction
+    # Some checks
+    if 'gpt2' in model_name.lower():
+        try:
+            # Should contain the dialogue history
+            # We call replace() to avoid issues with extra whitespace
+            assert template_turn["utterance"].replace(" ", "") in predicted_str.replace(" ", "")
+        except AssertionError:
+            logger.warning(f"{predicted_str} in {dialogue_id}_{i} does not match user utterance. Skipping.")
+            return
+    if "<EOS>" not in predicted_str:
+        logger.warning(f"No <EOS> token in {dialogue_id}_{i}. Skipping.")
+        return
+
+    # Extract string between <BOS> and <EOS>
+    if 'gpt2' in model_name.lower():
+        return re.search(r"<BOS>(.*)<EOS>", predicted_str).group(1).strip()
+    elif 't5' in model_name.lower():
+        return re.search(r"(.*)<EOS>", predicted_str).group(1).strip()
+    else:
+        raise ValueError("Unsupported model.")
+
+
 def populate_slots(
         predicted_data: dict,
         template_dialogue: dict,
@@ -94,32 +194,29 @@ def populate_slots(
                     service_schema = s
                     break
             assert service_schema is not None
+            if SERVICE_SLOT in predicted_data[i][service_name]:
+                # Whole service prediction
+                predicted_str = predicted_output_string(
+                    predicted_data[i][service_name][SERVICE_SLOT], template_turn, dialogue_id, i, model_name
+                )
+                if predicted_str is not None:
+                    active_intent, requested_slots, slot_values = parse_predicted_service_string(
+                        dialogue_id, i, predicted_str, separators, data_turn, service_name)
+                    frame["state"]["active_intent"] = active_intent
+                    frame["state"]["requested_slots"].extend(requested_slots)
+                    for slot_name, value in slot_values.items():
+                        frame["state"]["slot_values"][slot_name] = [value]
+                continue
             service_schema["slots"].append({"name": "*intent*"})  # for active intent prediction
 
             for slot_name in [slot["name"] for slot in service_schema["slots"]]:
                 # Loop over slots
-                predicted_str = predicted_data[i][service_name][slot_name]
-                # Some checks
-                if 'gpt2' in model_name.lower():
-                    try:
-                        # Should contain the dialogue history
-                        # We call replace() to avoid issues with extra whitespace
-                        assert template_turn["utterance"].replace(" ", "") in predicted_str.replace(" ", "")
-                    except AssertionError:
-                        logger.warning(f"{predicted_str} in {dialogue_id}_{i} does not match user utterance. Skipping.")
-                        continue
-                if "<EOS>" not in predicted_str:
-                    logger.warning(f"No <EOS> token in {dialogue_id}_{i}. Skipping.")
+                predicted_str = predicted_output_string(
+                    predicted_data[i][service_name][slot_name], template_turn, dialogue_id, i, model_name
+                )
+                if predicted_str is None:
                     continue
 
-                # Extract string between <BOS> and <EOS>
-                if 'gpt2' in model_name.lower():
-                    predicted_str = re.search(r"<BOS>(.*)<EOS>", predicted_str).group(1).strip()
-                elif 't5' in model_name.lower():
-                    predicted_str = re.search(r"(.*)<EOS>", predicted_str).group(1).strip()
-                else:
-                    raise ValueError("Unsupported model.")
-
                 if slot_name == "*intent*":
                     # Active intent prediction
                     extract_intent(service_schema, predicted_str, frame,
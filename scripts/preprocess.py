@@ -153,9 +153,51 @@ def get_slots(
     return result
 
 
+def get_services(
+        schema: List[dict],
+        intent_dict: dict,
+        slot_dict: dict
+) -> dict:
+    # Describes each service of the turn as a whole, for the `service' task format. Intents and categorical values
+    # are numbered as in intent_dict and slot_dict.
+    result = {}
+    for service in schema:
+        service_name = service["service_name"]
+        if service_name not in intent_dict:
+            continue
+        # Service: name : description Intents: 1: name : description ... Slots: 1: name : description
+        # [1: value 2: value ...] 2: name : description ...
+        description = "Service: " + humanise(service_name, remove_trailing_numbers=True) + \
+            SEPARATORS["description"] + service["description"].strip() + " Intents:"
+        intent_mapping = intent_dict[service_name]["mapping"]
+        for intent in sorted(service["intents"], key=lambda intent: intent_mapping[intent["name"]]):
+            description += " {}: ".format(intent_mapping[intent["name"]]) + intent["name"] + \
+                SEPARATORS["description"] + intent["description"].strip()
+        description += " Slots:"
+        slot_mapping = {}
+        for index, slot in enumerate(service["slots"], 1):
+            slot_name = slot["name"]
+            description += " {}: ".format(index) + humanise(slot_name) + SEPARATORS["description"] + \
+                slot["description"].strip()
+            value_mapping = slot_dict[service_name][slot_name]["mapping"]
+            if value_mapping:
+                description += " [" + " ".join(
+                    "{}: ".format(value_index) + value.strip()
+                    for value, value_index in sorted(value_mapping.items(), key=lambda item: item[1])
+                ) + "]"
+            slot_mapping[slot_name] = index
+
+        result[service_name] = {
+            "description": description.strip(),
+            "slot_mapping": slot_mapping
+        }
+    return result
+
+
 def process_file(
         schema: List[dict],
-        data: list
+        data: list,
+        task_format: str = "slot"
 ) -> dict:
     result = {}
     for dialogue in data:
@@ -184,6 +226,8 @@ def process_file(
                     "intent_dict": intent_dict,
                     "slot_dict": slot_dict
                 }
+                if task_format == "service":
+                    res["service_dict"] = get_services(schema, intent_dict, slot_dict)
                 result[dialogue_id].append(res)
 
             else:
@@ -195,6 +239,9 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--dir', help='Directory containing `dialogues_XXX.json` files', required=True)
     parser.add_argument('-o', '--out', help='Output file location and name', required=True)
+    parser.add_argument('--task-format', choices=['slot', 'service'], default='slot',
+                        help='`slot\' creates one example per slot of each service, `service\' also describes each '
+                             'service as a whole so that one example per service predicts its whole state')
     args = parser.parse_args()
 
     with open(os.path.join(args.dir, "schema.json")) as f:
@@ -205,7 +252,7 @@ def main():
         if pattern.match(file):
             with open(os.path.join(args.dir, file), "r") as f:
                 data = json.load(f)
-            result.update(process_file(schema, data))
+            result.update(process_file(schema, data, task_format=args.task_format))
 
     out = {
         "data": result,
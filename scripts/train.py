@@ -3,15 +3,18 @@ import logging
 import operator
 import pathlib
 import re
+import resource
 import sys
 import time
 from pathlib import Path
+from typing import Optional, Tuple
 
 import click
 import torch
 from omegaconf import OmegaConf
 from torch.utils.data import (
     DataLoader,
+    DistributedSampler,
     RandomSampler,
     SequentialSampler,
 )
@@ -32,59 +35,201 @@ from src.dst.dataset import (
     TrainDataset,
     Vocabulary
 )
-from src.dst.utils import set_seed, save_checkpoint, load_model, load_checkpoint
+from src.dst.distributed import (
+    all_reduce_gradients,
+    all_reduce_sum,
+    broadcast_parameters,
+    get_rank,
+    get_world_size,
+    init_distributed,
+    is_distributed,
+    is_main_process
+)
+from src.dst.modeling import lm_loss
+from src.dst.sampler import BucketBatchSampler
+from src.dst.utils import (
+    AsyncCheckpointWriter,
+    load_checkpoint,
+    load_model,
+    save_checkpoint,
+    set_gradient_checkpointing,
+    set_seed
+)
 
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 logger = logging.getLogger(__name__)
 
 
-def get_dataloader(args, tokenizer, filename, sampler, data_size=-1):
+def get_dataloader(args, tokenizer, filename, sampler, data_size=-1, seed=0):
     dataset = TrainDataset(args, tokenizer, filename, data_size)
+    shuffle = sampler is RandomSampler
+    if args.get('length_bucketing', False):
+        batch_sampler = BucketBatchSampler(
+            dataset.examples.lengths,
+            batch_size=args.batch_size,
+            max_tokens=args.get('max_tokens') or None,
+            shuffle=shuffle,
+            bucket_size=args.get('bucket_size', 100),
+            seed=seed,
+            num_replicas=get_world_size(),
+            rank=get_rank(),
+            # Replicas must take the same number of optimizer steps
+            drop_last=shuffle,
+        )
+        logger.info(f"Padding ratio for {filename}: {padding_ratio_report(batch_sampler)}")
+        return DataLoader(
+            dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=dataset.collate_fn
+        )
+    if is_distributed():
+        sampler = DistributedSampler(dataset, shuffle=shuffle, seed=seed, drop_last=shuffle)
+    else:
+        sampler = sampler(dataset)
     dataloader = DataLoader(
         dataset,
-        sampler=sampler(dataset),
+        sampler=sampler,
         batch_size=args.batch_size,
         collate_fn=dataset.collate_fn
     )
     return dataloader
 
 
-def score_dev(args, dataloader, model):
+def padding_ratio_report(batch_sampler: BucketBatchSampler) -> str:
+    return "{:.4f} ({} batches) vs {:.4f} without length bucketing".format(
+        batch_sampler.epoch_padding_ratio(), len(batch_sampler), batch_sampler.baseline_padding_ratio()
+    )
+
+
+def precision(args) -> torch.dtype:
+    """Autocast dtype when ``fp16`` is set: float16 on GPU, bfloat16 on CPU, where float16 is not supported."""
+    if not args.get('fp16', False):
+        return torch.float32
+    return torch.float16 if DEVICE.type == 'cuda' else torch.bfloat16
+
+
+def autocast(dtype: torch.dtype):
+    return torch.autocast(device_type=DEVICE.type, dtype=dtype, enabled=dtype != torch.float32)
+
+
+def peak_memory() -> float:
+    """Peak memory (MiB) allocated on the GPU or, on CPU, used by the process."""
+    if DEVICE.type == 'cuda':
+        return torch.cuda.max_memory_allocated(DEVICE) / 2 ** 20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def profile_step(args, model, batch, dtype: torch.dtype) -> Tuple[float, float]:
+    """Runs a forward and backward pass of `batch` without updating the model.
+
+    Returns
+    -------
+    memory
+        The memory (MiB) held by the activations saved for the backward pass.
+    step_time
+        The time of the step, in seconds.
+    """
+    model.train()
+    saved_bytes = 0
+
+    def pack(tensor):
+        nonlocal saved_bytes
+        saved_bytes += tensor.numel() * tensor.element_size()
+        return tensor
+
+    start_time = time.time()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor), autocast(dtype):
+        loss = lm_loss(args, model, batch, DEVICE)
+    loss.backward()
+    if DEVICE.type == 'cuda':
+        torch.cuda.synchronize(DEVICE)
+    step_time = time.time() - start_time
+    model.zero_grad()
+    return saved_bytes / 2 ** 20, step_time
+
+
+def checkpointing_report(args, model, batch, dtype: torch.dtype) -> str:
+    """Compares the memory held by the activations saved for the backward pass and the time of a training step of
+    `batch` without and with gradient checkpointing. Leaves the model with gradient checkpointing enabled.
+
+    The step without checkpointing needs the memory that checkpointing saves, so it may run out of memory on batches
+    which only fit with checkpointing.
+    """
+    results = {}
+    for enabled in (False, True):
+        set_gradient_checkpointing(model, enabled)
+        results[enabled] = profile_step(args, model, batch, dtype)
+    (memory, step_time), (checkpointed_memory, checkpointed_step_time) = results[False], results[True]
+    return "saved activations {:.0f} MiB -> {:.0f} MiB, step time {:.3f}s -> {:.3f}s ({:+.1%})".format(
+        memory, checkpointed_memory, step_time, checkpointed_step_time, checkpointed_step_time / step_time - 1
+    )
+
+
+def precision_report(args, model, batch, dtype: torch.dtype) -> str:
+    """Compares the memory held by the saved activations and the throughput of a training step of `batch` in float32
+    and in the mixed precision `dtype`.
+
+    Each step is run twice and the faster one is kept, so that the first step does not pay for the warm-up. The float32
+    step holds larger activations, so it may run out of memory on batches which only fit with mixed precision.
+    """
+    results = {}
+    for step_dtype in (torch.float32, dtype):
+        profiles = [profile_step(args, model, batch, step_dtype) for _ in range(2)]
+        results[step_dtype] = min(profiles, key=lambda profile: profile[1])
+    (memory, step_time), (mixed_memory, mixed_step_time) = results[torch.float32], results[dtype]
+    num_examples = batch['input_ids'].size(0)
+    return "saved activations {:.0f} MiB -> {:.0f} MiB, {:.2f} examples/s -> {:.2f} examples/s ({:.2f}x)".format(
+        memory, mixed_memory, num_examples / step_time, num_examples / mixed_step_time, step_time / mixed_step_time
+    )
+
+
+def score_dev(args, dataloader, model, dtype: torch.dtype = torch.float32):
     loss_total = 0
     num_batches = 0
     model.eval()
     start_time = time.time()
     for batch in tqdm(dataloader, desc="Dev", disable=args.verbose.disable_display):
         num_batches += 1
-        with torch.no_grad():
-            output = model(
-                input_ids=batch['input_ids'].to(DEVICE),
-                attention_mask=batch['attention_mask'].to(DEVICE),
-                labels=batch['label_ids'].to(DEVICE)
-            )
-        loss_total += output.loss.item()
+        with torch.no_grad(), autocast(dtype):
+            loss = lm_loss(args, model, batch, DEVICE)
+        loss_total += loss.item()
+    # Each process scores a shard of the dev set
+    loss_total, num_batches = all_reduce_sum([loss_total, num_batches])
     return loss_total / num_batches, time.time() - start_time
 
 
 def train(args, tokenizer, model, train_dataloader, dev_dataloader,
-          optimizer, scheduler, initial_step=0):
+          optimizer, scheduler, scaler, initial_step=0, checkpoint_writer: Optional[AsyncCheckpointWriter] = None):
     train_dev_args = args
     dev_args, train_args = args.dev, args.train
+    dtype = precision(train_args)
+    logger.info(f"Training precision: {dtype}")
     log_dir = Path().resolve().joinpath("runs/{}".format(train_args.experiment_name))
-    writer = SummaryWriter(
-        log_dir=str(log_dir),
-    )
-    logger.info(f"Tensorboard logs saved at: {log_dir}")
-    
-    eval_step = dev_args.eval_interval // train_args.batch_size
-    gstep = initial_step // train_args.batch_size
+    writer = None
+    if is_main_process():
+        writer = SummaryWriter(
+            log_dir=str(log_dir),
+        )
+        logger.info(f"Tensorboard logs saved at: {log_dir}")
 
-    loss_dev, t = score_dev(dev_args, dev_dataloader, model)
+    # Batches vary in size with max_tokens, so evaluation, logging and checkpoint names use the number of examples
+    # trained on by all processes rather than the number of steps
+    examples_seen = initial_step
+    next_eval = (examples_seen // dev_args.eval_interval + 1) * dev_args.eval_interval
+    gstep = initial_step // (train_args.batch_size * get_world_size())
+
+    loss_dev, t = score_dev(dev_args, dev_dataloader, model, dtype)
     logger.info(f"Epoch: {gstep} | Dev loss: {loss_dev:.8f} | Time: {t:.3f}")
     if gstep > 0:
         # We can't actually read the plot if we log that value
-        writer.add_scalar('Loss/dev', loss_dev, global_step=gstep * train_args.batch_size)
+        add_scalar(writer, 'Loss/dev', loss_dev, global_step=examples_seen)
     dev_loss_curve = [(loss_dev, t, 0)]
+    if train_args.get('gradient_checkpointing', False) and train_args.get('checkpointing_report', False):
+        report = checkpointing_report(train_args, model, next(iter(train_dataloader)), dtype)
+        logger.info(f"Gradient checkpointing: {report}")
+    if dtype != torch.float32 and train_args.get('precision_report', False):
+        report = precision_report(train_args, model, next(iter(train_dataloader)), dtype)
+        logger.info(f"Mixed precision ({dtype}) against float32: {report}")
     logger.info('Start training!')
 
     for epoch in range(train_args.epochs):
@@ -93,49 +238,90 @@ def train(args, tokenizer, model, train_dataloader, dev_dataloader,
         loss_disp = 0
         model.train()
         model.zero_grad()
+        num_examples, num_tokens, dev_time = 0, 0, 0.0
+        if DEVICE.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(DEVICE)
+        if isinstance(train_dataloader.batch_sampler, BucketBatchSampler):
+            train_dataloader.batch_sampler.set_epoch(epoch)
+            logger.info(f"Epoch: {epoch} | Padding ratio: {padding_ratio_report(train_dataloader.batch_sampler)}")
+        elif isinstance(train_dataloader.sampler, DistributedSampler):
+            train_dataloader.sampler.set_epoch(epoch)
 
         iterator = enumerate(tqdm(train_dataloader, desc=f"Epoch {epoch}", disable=train_args.verbose.disable_display))
         local_step = 0
         for local_step, batch in iterator:
-            output = model(
-                input_ids=batch['input_ids'].to(DEVICE),
-                attention_mask=batch['attention_mask'].to(DEVICE),
-                labels=batch['label_ids'].to(DEVICE),
-            )
-            loss = output.loss
-            loss_disp += output.loss.item()
+            with autocast(dtype):
+                loss = lm_loss(train_args, model, batch, DEVICE)
+            loss_disp += loss.item()
+            num_examples += batch['input_ids'].size(0)
+            num_tokens += int(batch['attention_mask'].sum())
+            # Summed over the processes, whose batches differ in size with max_tokens
+            examples_seen += int(all_reduce_sum([batch['input_ids'].size(0)])[0])
             gstep += 1
             # Update model
             if loss.item() != 0:
                 loss = loss / train_args.gradient_accumulation_steps
-                loss.backward()
+                scaler.scale(loss).backward()
             if gstep % train_args.gradient_accumulation_steps == 0:
-                optimizer.step()
+                if is_distributed():
+                    # Gradients are only exchanged once per optimizer step
+                    all_reduce_gradients(model)
+                if train_args.get('max_grad_norm'):
+                    # Clip the true gradients, not the scaled ones
+                    scaler.unscale_(optimizer)
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), train_args.max_grad_norm)
+                scaler.step(optimizer)
+                scaler.update()
                 if train_args.use_scheduler:
                     scheduler.step()
                 optimizer.zero_grad()
-            if gstep % eval_step == 0:
-                loss_dev, t = score_dev(dev_args, dev_dataloader, model)
+            if examples_seen >= next_eval:
+                while next_eval <= examples_seen:
+                    next_eval += dev_args.eval_interval
+                loss_dev, t = score_dev(dev_args, dev_dataloader, model, dtype)
+                dev_time += t
                 dev_loss_curve.append((loss_dev, t, gstep))
                 model.train()
                 logger.info(f"Epoch: {epoch} | Batch: {gstep} | Dev loss: {loss_dev:.8f} | Time: {t:.3f}")
-                writer.add_scalar('Loss/dev', loss_dev, global_step=gstep * train_args.batch_size)
-                save_checkpoint(train_dev_args, tokenizer, model, gstep * train_args.batch_size,
-                                optimizer, scheduler)
+                add_scalar(writer, 'Loss/dev', loss_dev, global_step=examples_seen)
+                if is_main_process():
+                    save = checkpoint_writer.save if checkpoint_writer is not None else save_checkpoint
+                    save(train_dev_args, tokenizer, model, examples_seen,
+                         optimizer, scheduler, scaler=scaler)
 
-        loss_disp /= (local_step + 1)
+        loss_disp, num_batches, num_examples, num_tokens = all_reduce_sum(
+            [loss_disp, local_step + 1, num_examples, num_tokens]
+        )
+        loss_disp /= num_batches
+        epoch_time = time.time() - start_time
         logger.info(
-            f"Epoch: {epoch} | Batch: {gstep} | Train loss: {loss_disp:.8f} | Time: {time.time() - start_time:.3f}")
-        writer.add_scalar('Loss/train', loss_disp, global_step=gstep * train_args.batch_size)
-        loss_dev, t = score_dev(dev_args, dev_dataloader, model)
+            f"Epoch: {epoch} | Batch: {gstep} | Train loss: {loss_disp:.8f} | Time: {epoch_time:.3f}")
+        # Throughput excludes the time spent scoring the dev set, compare with a run with fp16 off for the baseline
+        train_time = max(epoch_time - dev_time, 1e-9)
+        logger.info(
+            f"Epoch: {epoch} | Precision: {dtype} | {num_examples / train_time:.2f} examples/s | "
+            f"{num_tokens / train_time:.1f} tokens/s | Peak memory: {peak_memory():.0f} MiB"
+        )
+        add_scalar(writer, 'Loss/train', loss_disp, global_step=examples_seen)
+        add_scalar(writer, 'Throughput/train', num_examples / train_time, global_step=examples_seen)
+        if isinstance(train_dataloader.batch_sampler, BucketBatchSampler):
+            add_scalar(writer, 'Padding/train', train_dataloader.batch_sampler.epoch_padding_ratio(),
+                       global_step=examples_seen)
+        loss_dev, t = score_dev(dev_args, dev_dataloader, model, dtype)
         logger.info(f"Epoch: {epoch} | Batch: {gstep} | Dev loss: {loss_dev:.8f} | time: {t:.3f}")
-        writer.add_scalar('Loss/dev', loss_dev, global_step=gstep * train_args.batch_size)
+        add_scalar(writer, 'Loss/dev', loss_dev, global_step=examples_seen)
 
     dev_loss_curve.sort(key=operator.itemgetter(0))
     logger.info(
         f"Lowest dev loss: {dev_loss_curve[0][0]} | Step: {dev_loss_curve[0][2]} | Time: {dev_loss_curve[0][1]}.")
 
 
+def add_scalar(writer, tag, value, global_step):
+    # Only the main process writes TensorBoard logs
+    if writer is not None:
+        writer.add_scalar(tag, value, global_step=global_step)
+
+
 def set_model(args):
     # Initiate config, tokeniser and model
     config = AutoConfig.from_pretrained(args.model_name_or_path)
@@ -151,6 +337,8 @@ def set_model(args):
     vocabulary.add_special_tokens(args.special_tokens)
     tokenizer.add_special_tokens(vocabulary.special_tokens)
     model.resize_token_embeddings(len(tokenizer))
+    if args.get('gradient_checkpointing', False):
+        set_gradient_checkpointing(model)
     model.to(DEVICE)
     return config, tokenizer, model
 
@@ -190,30 +378,71 @@ def set_model(args):
     type=click.Path(exists=True, path_type=Path),
     help="Path to the checkpoint folder from where the model is to be loaded.",
 )
+@click.option(
+    "-n",
+    "--num-processes",
+    "num_processes",
+    type=int,
+    default=1,
+    help="Number of data-parallel training processes. Batches are split between processes, which communicate with "
+         "the gloo backend so that CPU-only machines are supported.",
+)
 def main(
         args_path: pathlib.Path,
         train_path: pathlib.Path,
         dev_path: pathlib.Path,
         log_level: int,
-        ckpt_path: pathlib.Path
+        ckpt_path: pathlib.Path,
+        num_processes: int,
 ):
     args = OmegaConf.load(args_path)
+    if num_processes > 1:
+        torch.multiprocessing.spawn(
+            run,
+            args=(num_processes, args, train_path, dev_path, log_level, ckpt_path),
+            nprocs=num_processes
+        )
+    else:
+        run(0, 1, args, train_path, dev_path, log_level, ckpt_path)
+
+
+def run(
+        rank: int,
+        world_size: int,
+        args,
+        train_path: pathlib.Path,
+        dev_path: pathlib.Path,
+        log_level: int,
+        ckpt_path: pathlib.Path
+):
+    global DEVICE
+    if world_size > 1:
+        init_distributed(rank, world_size, port=args.train.get('master_port', 29500))
+        if DEVICE.type == 'cuda':
+            DEVICE = torch.device('cuda', rank % torch.cuda.device_count())
     log_dir = Path(args.train.checkpoint_dir).joinpath(args.train.experiment_name, 'logs').resolve()
     if not log_dir.exists():
         log_dir.mkdir(exist_ok=True, parents=True)
     handlers = [
         logging.StreamHandler(sys.stdout),
         logging.StreamHandler(sys.stderr),
-        logging.FileHandler(
-            '{}.log'.format(log_dir.joinpath(Path(__file__).stem)),
-            mode='a' if ckpt_path else 'w',
-        )
     ]
+    if rank == 0:
+        handlers.append(
+            logging.FileHandler(
+                '{}.log'.format(log_dir.joinpath(Path(__file__).stem)),
+                mode='a' if ckpt_path else 'w',
+            )
+        )
+    else:
+        # Other processes only report problems
+        log_level = max(log_level, logging.WARNING)
     logging.basicConfig(
         handlers=handlers,
         level=log_level,
         datefmt="%Y-%m-%d %H:%M",
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        format=f"%(asctime)s - {rank} - %(name)s - %(levelname)s - %(message)s" if world_size > 1 else
+        "%(asctime)s - %(name)s - %(levelname)s - %(message)s",
     )
     logger.setLevel(log_level)
     if ckpt_path:
@@ -237,20 +466,26 @@ def main(
         config, tokenizer, model, = load_model(args.train, device=DEVICE)
     else:
         config, tokenizer, model = set_model(args.train)
+    if world_size > 1:
+        broadcast_parameters(model)
+        # Replicas start from the same weights but draw different dropout masks
+        set_seed(args.reproduce, offset=rank)
 
     train_dataloader = get_dataloader(
         args.train,
         tokenizer,
         args.train.dst_train_path,
         sampler=RandomSampler,
-        data_size=args.train.data_size
+        data_size=args.train.data_size,
+        seed=args.reproduce.seed
     )
     dev_dataloader = get_dataloader(
         args.dev,
         tokenizer,
         args.dev.dst_dev_path,
         sampler=SequentialSampler,
-        data_size=args.dev.data_size
+        data_size=args.dev.data_size,
+        seed=args.reproduce.seed
     )
     
     # if 'gpt2' in args.train.model_name_or_path.lower():
@@ -278,11 +513,28 @@ def main(
             num_warmup_steps=args.train.warmup_steps,
             num_training_steps=t_total
         )
+    # Gradient scaling prevents float16 gradients from underflowing, bfloat16 has the range of float32
+    scaler = torch.cuda.amp.GradScaler(enabled=precision(args.train) == torch.float16)
     if ckpt_path:
-        optimizer, scheduler = load_checkpoint(ckpt_path, optimizer, scheduler)
+        optimizer, scheduler = load_checkpoint(ckpt_path, optimizer, scheduler, scaler=scaler)
 
-    train(args, tokenizer, model, train_dataloader, dev_dataloader,
-          optimizer, scheduler, initial_step=initial_step)
+    checkpoint_writer = None
+    if args.train.get('async_checkpointing', False) and rank == 0:
+        checkpoint_writer = AsyncCheckpointWriter(max_pending=args.train.get('max_pending_checkpoints', 1))
+    try:
+        train(args, tokenizer, model, train_dataloader, dev_dataloader,
+              optimizer, scheduler, scaler, initial_step=initial_step, checkpoint_writer=checkpoint_writer)
+    except BaseException:
+        # Flush the last checkpoints without replacing the training error by a write error
+        if checkpoint_writer is not None:
+            try:
+                checkpoint_writer.close()
+            except RuntimeError:
+                logger.exception("Could not save the last checkpoints")
+        raise
+    # Flush the last checkpoints
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Optional
+
+from src.dst.examples import Examples
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the layout of the cached examples or the way they are created changes
+CACHE_VERSION = 4
+
+
+def file_digest(filename: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def tokenizer_digest(tokenizer) -> str:
+    digest = hashlib.sha1()
+    digest.update(type(tokenizer).__name__.encode())
+    digest.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode())
+    digest.update(json.dumps(tokenizer.all_special_tokens).encode())
+    return digest.hexdigest()
+
+
+def cache_key(filename: str, tokenizer, settings: dict) -> str:
+    """Returns the name of the cache entry for the examples created from `filename`.
+
+    Parameters
+    ----------
+    filename:
+        Path to the preprocessed data file.
+    tokenizer:
+        Tokenizer used to create the examples.
+    settings:
+        Any other option which changes the examples (e.g., model family, ``max_seq_len``, ``data_size``).
+    """
+    key = {
+        'version': CACHE_VERSION,
+        'data': file_digest(filename),
+        'tokenizer': tokenizer_digest(tokenizer),
+        'settings': settings,
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def save_examples(path: Path, examples: Examples, separators: dict):
+    """Saves the examples as flat token arrays plus offsets (see `Examples`).
+
+    The entry is written to a temporary directory which is then renamed, so concurrent jobs reading the same data
+    file never see a partially written cache.
+    """
+    tmp_path = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+    tmp_path.mkdir(parents=True, exist_ok=True)
+    examples.save(tmp_path)
+    with open(tmp_path.joinpath("separators.json"), 'w') as f:
+        json.dump(separators, f)
+    try:
+        os.rename(tmp_path, path)
+        logger.info(f"Cached {len(examples)} examples in {path}")
+    except OSError:
+        # Another job cached the same examples first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_examples(path: Path) -> Optional[tuple[Examples, dict]]:
+    """Loads cached examples and separators.
+
+    The token arrays are memory-mapped, so their pages are shared between all the processes which map the same cache
+    entry.
+    """
+    if not path.joinpath("separators.json").exists():
+        return None
+    with open(path.joinpath("separators.json"), 'r') as f:
+        separators = json.load(f)
+    return Examples.load(path), separators
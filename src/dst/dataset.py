@@ -3,11 +3,15 @@ from __future__ import annotations
 import json
 import logging
 from dataclasses import dataclass, field
-from typing import Union
+from pathlib import Path
+from typing import Optional, Union
 
 import torch
 from tqdm import tqdm
 
+from src.dst.cache import cache_key, load_examples, save_examples
+from src.dst.examples import Examples
+
 logger = logging.getLogger(__name__)
 
 SPECIAL_TOKENS = {
@@ -18,6 +22,10 @@ SPECIAL_TOKENS = {
     "additional_special_tokens": ["<USR>", "<SYS>"]
 }
 
+# Slot of the examples which predict the whole state of a service with the `service' task format. scripts/parse.py
+# defines the same value, as it does not import this module, so the two must be changed together
+SERVICE_SLOT = "*service*"
+
 
 @dataclass
 class Vocabulary:
@@ -46,11 +54,133 @@ class DSTDataset(torch.utils.data.Dataset):
         self.eos_id = tokenizer.eos_token_id
         self.ignore_token_id = -100
         self.max_seq_len = args.max_seq_len
+        # description_first: description context; context_first: context <SEP> description, so that the examples of a
+        # turn share the context as a prefix and its key/values can be computed once when decoding
+        self.prompt_layout = args.get('prompt_layout', 'description_first')
+        if self.prompt_layout not in ('description_first', 'context_first'):
+            raise ValueError(f"Unknown prompt layout: {self.prompt_layout}.")
+        # slot: one example per intent and per slot of each service; service: one example per service, predicting
+        # its active intent, requested slots and slot values together
+        self.task_format = args.get('task_format', 'slot')
+        if self.task_format not in ('slot', 'service'):
+            raise ValueError(f"Unknown task format: {self.task_format}.")
+        cache_path = self._cache_path()
+        if cache_path is not None:
+            cached = load_examples(cache_path)
+            if cached is not None:
+                self.examples, self.separators = cached
+                logger.info(f"Loaded {len(self.examples)} cached examples for {filename} from {cache_path}")
+                return
         with open(filename, 'r') as f:
             dataset = json.load(f)
             self.data = dataset["data"]
             self.separators = dataset["separators"]
+        if self.task_format == 'service' and not self._has_service_descriptions():
+            raise ValueError(f"{filename} has no service descriptions, run preprocess.py with --task-format service.")
+        # Any special token splits the text before sub-word tokenization, so a piece of the model input followed by
+        # this token is tokenized exactly as it is inside the full model input
+        self.boundary_token = "<USR>"
+        self.boundary_id = tokenizer.convert_tokens_to_ids(self.boundary_token)
+        self._description_ids: dict[str, list[int]] = {}
+        self._target_ids: dict[str, list[int]] = {}
+        self.examples = Examples()
         self._create_examples()
+        self.examples.finalize()
+        # Examples hold everything needed downstream, so the raw data need not stay alive for the whole run
+        del self.data
+        self._description_ids.clear()
+        self._target_ids.clear()
+        if cache_path is not None and len(self.examples):
+            save_examples(cache_path, self.examples, self.separators)
+
+    def _cache_settings(self) -> dict:
+        # Options other than the data file and the tokenizer which change the examples
+        return {
+            'dataset': type(self).__name__,
+            'model': self.model_family,
+            'max_seq_len': self.max_seq_len,
+            'data_size': self.data_size,
+            'prompt_layout': self.prompt_layout,
+            'task_format': self.task_format,
+        }
+
+    def _has_service_descriptions(self) -> bool:
+        return all('service_dict' in turn for dialogue in self.data.values() for turn in dialogue)
+
+    def _cache_path(self) -> Optional[Path]:
+        cache_dir = self.args.get('cache_dir')
+        if not cache_dir:
+            return None
+        return Path(cache_dir).joinpath(cache_key(self.filename, self.tokenizer, self._cache_settings()))
+
+    @property
+    def model_family(self) -> str:
+        for family in ('gpt2', 't5'):
+            if family in self.args.model_name_or_path.lower():
+                return family
+        raise ValueError("Unsupported model.")
+
+    def _encode(self, text: str, closed: bool = True) -> list[int]:
+        # Tokenize a piece of the model input without the model specific special tokens. Closed pieces are followed
+        # by a special token (<SYS>, <USR>) in the model input, open pieces end the model input.
+        if not closed:
+            return self.tokenizer(text, add_special_tokens=False)['input_ids']
+        ids = self.tokenizer(f"{text} {self.boundary_token}", add_special_tokens=False)['input_ids']
+        assert ids[-1] == self.boundary_id
+        return ids[:-1]
+
+    def _encode_description(self, description: str) -> list[int]:
+        # Descriptions are shared across turns and dialogues so they are tokenized once
+        if description not in self._description_ids:
+            # The model input is stripped, so leading whitespace does not reach the tokenizer
+            stripped = description.lstrip()
+            self._description_ids[description] = self._encode(stripped) if stripped else []
+        return self._description_ids[description]
+
+    def _encode_target(self, target: str) -> list[int]:
+        if target not in self._target_ids:
+            self._target_ids[target] = self.tokenizer(target)['input_ids']
+        return self._target_ids[target]
+
+    def _dialogue_contexts(self, dialogue: list[dict]):
+        """Tokenizes the dialogue history incrementally.
+
+        Each utterance is tokenized once per dialogue and the history is kept as token ids which are extended turn by
+        turn. The ids of ``description + " " + context`` for a turn are obtained by joining the description ids with
+        the context ids yielded for that turn (see `_model_input_ids`).
+
+        With the ``context_first`` layout, all utterances are followed by a special token (the description starts
+        with <SEP>), so the context yielded for a turn is a prefix of the context yielded for the next turn and the
+        ids of ``context + "<SEP> " + description`` are the context ids joined with the description ids.
+
+        Yields
+        ------
+        turn_index, turn, context_ids
+        """
+        context_ids = []
+        for turn_index, turn in enumerate(dialogue):
+            user_utterance = turn['user_utterance']
+            system_utterance = turn['system_utterance']
+            if system_utterance:
+                context_ids += self._encode(f"<SYS> {system_utterance}")
+            if self.prompt_layout == 'context_first':
+                context_ids += self._encode(f"<USR> {user_utterance}")
+                yield turn_index, turn, list(context_ids)
+                continue
+            # The last user utterance ends the model input, which is stripped
+            yield turn_index, turn, context_ids + self._encode(f"<USR> {user_utterance}".rstrip(), closed=False)
+            context_ids += self._encode(f"<USR> {user_utterance}")
+
+    def _model_input_ids(self, description: str, context_ids: list[int]) -> list[int]:
+        if self.prompt_layout == 'context_first':
+            # <USR> ... <SYS> ... <USR> ... <SEP> description
+            # Same ids as self.tokenizer((context + "<SEP> " + description.strip()).strip())['input_ids']: the special
+            # token separates the last utterance from the description as it separates the utterances
+            if description not in self._description_ids:
+                self._description_ids[description] = self._encode(f"<SEP> {description.strip()}", closed=False)
+            return self.tokenizer.build_inputs_with_special_tokens(context_ids + self._description_ids[description])
+        # Same ids as self.tokenizer((description + " " + context).strip())['input_ids']
+        return self.tokenizer.build_inputs_with_special_tokens(self._encode_description(description) + context_ids)
 
     @staticmethod
     def _pad(sentences, pad_id, side="right"):
@@ -81,10 +211,11 @@ class TrainDataset(DSTDataset):
         super().__init__(args, tokenizer, filename, data_size)
 
     def _create_examples(self):
-        self.examples = []
         over_length = 0
         skip_counter = 0
         intent_examples = 0
+        service_examples = 0
+        num_turns = 0
         for dialogue_id, dialogue in tqdm(
                 self.data.items(),
                 desc=f"Loading {self.filename}\n",
@@ -92,15 +223,21 @@ class TrainDataset(DSTDataset):
         ):
             if self.data_size != -1 and len(self.examples) >= self.data_size:
                 break
-            context = ""
-            for turn_index, turn in enumerate(dialogue):
+            for turn_index, turn, context in self._dialogue_contexts(dialogue):
                 user_utterance = turn['user_utterance']
-                system_utterance = turn['system_utterance']
-                if not system_utterance:
-                    utterance = f"<USR> {user_utterance} "
-                else:
-                    utterance = f"<SYS> {system_utterance} <USR> {user_utterance} "
-                context += utterance
+                num_turns += 1
+
+                if self.task_format == 'service':
+                    for service in turn['service_dict']:
+                        # Service: description Intents: 1: intent ... Slots: 1: slot [1: value ...] ...
+                        # <USR> ... <SYS> ... <USR> ...
+                        # intent = index <SEP> requested = slot slot ... <SEP> slot = value <SEP> ...
+                        context_ids = self._model_input_ids(turn['service_dict'][service]["description"], context)
+                        target_ids = self._encode_target(self.service_target(turn, service))
+                        over_length = self.create_ids(
+                            dialogue_id, turn_index, context_ids, target_ids, user_utterance, over_length)
+                        service_examples += 1
+                    continue
 
                 # Intent
                 for service in turn['intent_dict']:
@@ -109,12 +246,11 @@ class TrainDataset(DSTDataset):
                     mapping = turn['intent_dict'][service]["mapping"]
                     # Intent: Service: description 1: intent 2: intent ...
                     # <USR> ... <SYS> ... <USR> ...
-                    model_input = description + " " + context
-                    context_ids = self.tokenizer(model_input.strip())['input_ids']
+                    context_ids = self._model_input_ids(description, context)
                     if active:
-                        target_ids = self.tokenizer(str(mapping[active]))['input_ids']
+                        target_ids = self._encode_target(str(mapping[active]))
                     else:
-                        target_ids = self.tokenizer("")['input_ids']
+                        target_ids = self._encode_target("")
                     over_length = self.create_ids(
                         dialogue_id, turn_index, context_ids, target_ids, user_utterance, over_length)
                     intent_examples += 1
@@ -140,16 +276,41 @@ class TrainDataset(DSTDataset):
                         # Categorical/Non-categorical: Service: description Slot: description
                         # [1: value 2: value ...] <USR> ... <SYS> ... <USR> ...
                         # requested = true/false <SEP> value = value
-                        model_input = description + " " + context
-                        context_ids = self.tokenizer(model_input.strip())['input_ids']
-                        target_ids = self.tokenizer(target.strip())['input_ids']
+                        context_ids = self._model_input_ids(description, context)
+                        target_ids = self._encode_target(target.strip())
                         over_length = self.create_ids(
                             dialogue_id, turn_index, context_ids, target_ids, user_utterance, over_length)
 
         logger.info(f"Data statistics: {self.filename}: {len(self.examples)} examples")
-        logger.info(f"Data statistics: {self.filename}: {intent_examples} intent examples")
+        if self.task_format == 'service':
+            logger.info(f"Data statistics: {self.filename}: {service_examples} service examples")
+        else:
+            logger.info(f"Data statistics: {self.filename}: {intent_examples} intent examples")
+        logger.info(
+            f"Data statistics: {self.filename}: {len(self.examples) / max(num_turns, 1):.2f} examples per turn"
+        )
         logger.info(f"Number of over-length examples: {self.filename}: {over_length} examples")
 
+    def service_target(self, turn: dict, service: str) -> str:
+        """The state of a service as one target: the index of the active intent, the indices of the requested slots
+        and the value of each slot which has one, categorical values being indices into the mapping of the slot."""
+        pair, default = self.separators["pair"], self.separators["default"]
+        intent = turn['intent_dict'][service]
+        slots = turn['slot_dict'][service]
+        slot_mapping = turn['service_dict'][service]["slot_mapping"]
+        parts = [
+            "intent" + pair + (str(intent["mapping"][intent["active"]]) if intent["active"] else ""),
+            "requested" + pair + " ".join(str(slot_mapping[slot]) for slot in slots if slots[slot]["requested"])
+        ]
+        for slot, slot_dict in slots.items():
+            value = slot_dict["value"]
+            if not value:
+                continue
+            if slot_dict["mapping"]:
+                value = "dontcare" if value == "dontcare" else str(slot_dict["mapping"][value])
+            parts.append(str(slot_mapping[slot]) + pair + value)
+        return default.join(part.strip() for part in parts)
+
     def create_ids(self, dialogue_id, turn_index, context_ids, target_ids, user_utterance, over_length):
         target_len = len(target_ids)
         if 'gpt2' in self.args.model_name_or_path.lower():
@@ -171,12 +332,12 @@ class TrainDataset(DSTDataset):
             input_ids = input_ids[-self.max_seq_len:]
             label_ids = label_ids[-self.max_seq_len:]
         assert len(input_ids) <= self.max_seq_len
-        self.examples.append({
-            'input_ids': input_ids,
-            'label_ids': label_ids,
-            'user_utterance': user_utterance,  # useful for results analysis
-            'example_id': f"{dialogue_id}_{turn_index}",
-        })
+        self.examples.append(
+            example_id=f"{dialogue_id}_{turn_index}",
+            user_utterance=user_utterance,  # useful for results analysis
+            input_ids=input_ids,
+            label_ids=label_ids,
+        )
         return over_length
 
     def collate_fn(self, batch):
@@ -200,58 +361,96 @@ class TrainDataset(DSTDataset):
 class TestDataset(DSTDataset):
     def __init__(self, args, tokenizer, filename, data_size):
         self.to_decode: set[str] = set(args.decode_only)
+        # Only the examples of the dialogues in shard `shard_index` of `num_shards` are created
+        self.num_shards = args.get('num_shards', 1)
+        self.shard_index = args.get('shard_index', 0)
+        if not 0 <= self.shard_index < self.num_shards:
+            raise ValueError(f"Invalid shard index {self.shard_index} for {self.num_shards} shards.")
+        self._candidate_ids: dict[tuple[int, bool], Optional[list[list[int]]]] = {}
         super().__init__(args, tokenizer, filename, data_size)
 
+    def _cache_settings(self) -> dict:
+        settings = super()._cache_settings()
+        settings['decode_only'] = sorted(self.to_decode)
+        if self.num_shards > 1:
+            settings['shard'] = [self.shard_index, self.num_shards]
+        return settings
+
+    def _dialogue_ids(self) -> list[str]:
+        """Ids of the dialogues to decode, in data order.
+
+        These are the dialogues in ``decode_only`` (all if empty) until ``data_size`` examples are reached. When
+        sharding, they are split into ``num_shards`` contiguous blocks and only the block ``shard_index`` is kept, so
+        that concatenating the outputs of the shards in order gives the output of a single run.
+        """
+        dialogue_ids, num_examples = [], 0
+        for dialogue_id, dialogue in self.data.items():
+            if self.to_decode and dialogue_id not in self.to_decode:
+                continue
+            if self.data_size != -1 and num_examples >= self.data_size:
+                break
+            dialogue_ids.append(dialogue_id)
+            num_examples += sum(map(self._num_examples, dialogue))
+        start = len(dialogue_ids) * self.shard_index // self.num_shards
+        end = len(dialogue_ids) * (self.shard_index + 1) // self.num_shards
+        return dialogue_ids[start:end]
+
+    def _num_examples(self, turn: dict) -> int:
+        if self.task_format == 'service':
+            return len(turn['service_dict'])
+        # One example per intent and one per slot
+        return len(turn['intent_dict']) + sum(map(len, turn['slot_dict'].values()))
+
     def _create_examples(self):
-        self.examples = []
         over_length = 0
-        for dialogue_id, dialogue in tqdm(
-                self.data.items(),
+        for dialogue_id in tqdm(
+                self._dialogue_ids(),
                 desc=f"Loading {self.filename}",
                 disable=self.args.verbose.disable_display
         ):
-            if self.to_decode and dialogue_id not in self.to_decode:
-                continue
-            if self.data_size != -1 and len(self.examples) >= self.data_size:
-                break
-            context = ""
-            for turn_index, turn in enumerate(dialogue):
+            dialogue = self.data[dialogue_id]
+            for turn_index, turn, context in self._dialogue_contexts(dialogue):
                 user_utterance = turn['user_utterance']
-                system_utterance = turn['system_utterance']
-                if not system_utterance:
-                    utterance = f"<USR> {user_utterance} "
-                else:
-                    utterance = f"<SYS> {system_utterance} <USR> {user_utterance} "
-                context += utterance
+
+                if self.task_format == 'service':
+                    for service in turn['service_dict']:
+                        # Service: description Intents: 1: intent ... Slots: 1: slot [1: value ...] ...
+                        # <USR> ... <SYS> ... <USR> ...
+                        context_ids = self._model_input_ids(turn['service_dict'][service]["description"], context)
+                        over_length = self.create_ids(
+                            dialogue_id, turn_index, context_ids, user_utterance, over_length, service=service,
+                            slot=SERVICE_SLOT)
+                    continue
 
                 # Intent
                 for service in turn['intent_dict']:
                     description = turn['intent_dict'][service]["description"]
                     # Intent: Service: description 1: intent 2: intent ...
                     # <USR> ... <SYS> ... <USR> ...
-                    model_input = description + " " + context
-                    context_ids = self.tokenizer(model_input.strip())['input_ids']
+                    mapping = turn['intent_dict'][service]["mapping"]
+                    context_ids = self._model_input_ids(description, context)
                     over_length = self.create_ids(
-                        dialogue_id, turn_index, context_ids, user_utterance, over_length, service=service)
+                        dialogue_id, turn_index, context_ids, user_utterance, over_length, service=service,
+                        choices=len(mapping))
 
                 # Iterate per slot
                 for service in turn['slot_dict']:
                     for slot in turn['slot_dict'][service]:
                         description = turn['slot_dict'][service][slot]["description"]
+                        mapping = turn['slot_dict'][service][slot]["mapping"]
                         # Categorical/Non-categorical: Service: description Slot: description
                         # [1: value 2: value ...] <USR> ... <SYS> ... <USR> ...
                         # requested = true/false <SEP> value = value
-                        model_input = description + " " + context
-                        context_ids = self.tokenizer(model_input.strip())['input_ids']
+                        context_ids = self._model_input_ids(description, context)
                         over_length = self.create_ids(
                             dialogue_id, turn_index, context_ids, user_utterance, over_length,
-                            service=service, slot=slot)
+                            service=service, slot=slot, choices=len(mapping) if mapping else -1)
 
         logger.info(f"Data statistics: {self.filename}: {len(self.examples)} examples")
         logger.info(f"Number of over-length examples: {self.filename}: {over_length} examples")
 
     def create_ids(self, dialogue_id, turn_index, context_ids, user_utterance, over_length,
-                   service=None, slot=None):
+                   service=None, slot=None, choices=-1):
         if 'gpt2' in self.args.model_name_or_path.lower():
             # context <BOS> target <EOS>
             dst_input_ids = context_ids + [self.tokenizer.bos_token_id]
@@ -262,33 +461,69 @@ class TestDataset(DSTDataset):
         if len(dst_input_ids) > self.max_seq_len:
             over_length += 1
             dst_input_ids = dst_input_ids[-self.max_seq_len:]
-        self.examples.append({
-            'input_ids': dst_input_ids,
-            'example_id': f"{dialogue_id}_{turn_index}",
-            'user_utterance': user_utterance,
-            'service': service,
-            'slot': slot
-        })
+        self.examples.append(
+            example_id=f"{dialogue_id}_{turn_index}",
+            user_utterance=user_utterance,
+            service=service,
+            slot=slot,
+            choices=choices,
+            input_ids=dst_input_ids,
+        )
         return over_length
 
     def collate_fn(self, batch):
         input_ids = [example['input_ids'] for example in batch]
-        input_ids, attention_mask = self._pad(input_ids, self.pad_id)
+        # Generation appends tokens to the right of the context
+        input_ids, attention_mask = self._pad(input_ids, self.pad_id, side="left")
         input_ids = torch.tensor(input_ids).long()
         attention_mask = torch.tensor(attention_mask).long()
         example_id = [example['example_id'] for example in batch]
         user_utterances = [example['user_utterance'] for example in batch]
         services = [example['service'] for example in batch]
         slots = [example['slot'] for example in batch]
+        candidates = [self.candidate_ids(example['choices'], example['slot']) for example in batch]
         return {
             'input_ids': input_ids,
             'attention_mask': attention_mask,
             'example_id': example_id,
             'user_utterance': user_utterances,
             'service': services,
-            'slot': slots
+            'slot': slots,
+            'candidates': candidates
         }
 
+    def candidate_targets(self, choices: int, slot: Optional[str] = None) -> Optional[list[str]]:
+        """Lists the targets the model can output for an intent or categorical slot example.
+
+        The targets are formatted as in `TrainDataset`, the values being indices into the mapping of the example.
+        Returns `None` for non-categorical slots, whose values are free-form.
+        """
+        if choices < 0:
+            return None
+        values = [""] + [str(index) for index in range(1, choices + 1)]
+        if slot is None:
+            return values
+        values.insert(1, "dontcare")
+        return [self.slot_target(requested, value) for requested in ('true', 'false') for value in values]
+
+    def slot_target(self, requested: str, value: str) -> str:
+        return ("requested" + self.separators["pair"] + requested + self.separators["default"] + "value" +
+                self.separators["pair"] + value).strip()
+
+    def inactive_slot_ids(self) -> list[int]:
+        """Token ids of the target of a slot which is neither requested nor has a value, followed by <EOS>."""
+        return self.tokenizer(self.slot_target('false', ""))['input_ids'] + [self.eos_id]
+
+    def candidate_ids(self, choices: int, slot: Optional[str] = None) -> Optional[list[list[int]]]:
+        """Token ids of `candidate_targets`, followed by <EOS>."""
+        key = (choices, slot is not None)
+        if key not in self._candidate_ids:
+            targets = self.candidate_targets(choices, slot)
+            self._candidate_ids[key] = None if targets is None else [
+                self.tokenizer(target)['input_ids'] + [self.eos_id] for target in targets
+            ]
+        return self._candidate_ids[key]
+
 
 if __name__ == '__main__':
     pass
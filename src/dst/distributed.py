@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import logging
+import os
+
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+logger = logging.getLogger(__name__)
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def init_distributed(rank: int, world_size: int, backend: str = 'gloo', port: int = 29500):
+    """Joins the process group of a single node data-parallel run.
+
+    Each process gets an equal share of the CPU cores, since all processes would otherwise use every core.
+    """
+    os.environ.setdefault('MASTER_ADDR', 'localhost')
+    os.environ.setdefault('MASTER_PORT', str(port))
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    logger.info(f"Process {rank} of {world_size} uses {torch.get_num_threads()} threads")
+
+
+def broadcast_parameters(model: torch.nn.Module):
+    """Copies the parameters of the first process to the others, so that all replicas start from the same model.
+
+    Floating point buffers are copied too, other buffers (e.g. the causal attention masks of GPT-2) are identical.
+    """
+    buffers = [buffer for buffer in model.buffers() if buffer.is_floating_point()]
+    for tensor in [*model.parameters(), *buffers]:
+        dist.broadcast(tensor.data, src=0)
+
+
+def all_reduce_gradients(model: torch.nn.Module, bucket_size: int = 2 ** 24):
+    """Averages the gradients of the replicas.
+
+    Gradients are flattened into buckets of about `bucket_size` elements to reduce the number of collective calls.
+    Called once per optimizer step, so gradients accumulated over several batches are only communicated once.
+    """
+    grads = []
+    for parameter in model.parameters():
+        if not parameter.requires_grad:
+            continue
+        if parameter.grad is None:
+            # Every replica must reduce the same tensors
+            parameter.grad = torch.zeros_like(parameter)
+        grads.append(parameter.grad)
+    world_size = get_world_size()
+    bucket, size = [], 0
+    for index, grad in enumerate(grads):
+        bucket.append(grad)
+        size += grad.numel()
+        last = index == len(grads) - 1
+        if size >= bucket_size or last or grads[index + 1].dtype != grad.dtype:
+            flat = _flatten_dense_tensors(bucket)
+            dist.all_reduce(flat)
+            flat /= world_size
+            for grad_, reduced in zip(bucket, _unflatten_dense_tensors(flat, bucket)):
+                grad_.copy_(reduced)
+            bucket, size = [], 0
+
+
+def all_reduce_sum(values: list[float]) -> list[float]:
+    """Sums scalars (e.g. losses and batch counts) across processes."""
+    if not is_distributed():
+        return values
+    tensor = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(tensor)
+    return tensor.tolist()
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import json
+from array import array
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+
+TOKEN_FIELDS = ('input_ids', 'label_ids')
+INDEX_FIELDS = ('turn', 'service', 'slot', 'choices')
+
+
+class Examples(Sequence):
+    """Compact storage for the examples of a `DSTDataset`.
+
+    The token ids of all examples are stored in one contiguous int32 buffer per field with an offset array, so that
+    the ids of example ``i`` are ``buffer[offsets[i]:offsets[i + 1]]``. Example ids and user utterances are stored
+    once per turn and services and slots are interned, each example only keeping indices into these tables.
+
+    Examples are added with `append` and `finalize` must be called before they are indexed.
+    """
+
+    def __init__(self):
+        self.tokens: dict[str, Union[array, np.ndarray]] = {}
+        self.offsets: dict[str, Union[array, np.ndarray]] = {}
+        # Per turn tables, indexed by self.turn
+        self.example_ids: list[str] = []
+        self.user_utterances: list[str] = []
+        # Interned strings, indexed by self.service and self.slot (-1 for None)
+        self.services: list[str] = []
+        self.slots: list[str] = []
+        self.turn = array('i')
+        self.service = array('i')
+        self.slot = array('i')
+        # Number of values of the mapping of intent and categorical slot examples, -1 for other examples
+        self.choices = array('i')
+        self._index: dict[str, dict[str, int]] = {'services': {}, 'slots': {}}
+
+    def _intern(self, table: str, value: Optional[str]) -> int:
+        if value is None:
+            return -1
+        index = self._index[table]
+        if value not in index:
+            index[value] = len(getattr(self, table))
+            getattr(self, table).append(value)
+        return index[value]
+
+    def append(self, example_id: str, user_utterance: str, service: Optional[str] = None,
+               slot: Optional[str] = None, choices: int = -1, **token_ids: list[int]):
+        if not self.example_ids or self.example_ids[-1] != example_id:
+            self.example_ids.append(example_id)
+            self.user_utterances.append(user_utterance)
+        self.turn.append(len(self.example_ids) - 1)
+        self.service.append(self._intern('services', service))
+        self.slot.append(self._intern('slots', slot))
+        self.choices.append(choices)
+        for name, ids in token_ids.items():
+            if name not in self.tokens:
+                self.tokens[name] = array('i')
+                self.offsets[name] = array('q', [0])
+            self.tokens[name].extend(ids)
+            self.offsets[name].append(len(self.tokens[name]))
+
+    def finalize(self) -> Examples:
+        # Convert the growable buffers to arrays, which pickle and memory-map compactly
+        self.tokens = {name: np.asarray(buffer, dtype=np.int32) for name, buffer in self.tokens.items()}
+        self.offsets = {name: np.asarray(buffer, dtype=np.int64) for name, buffer in self.offsets.items()}
+        self.turn = np.asarray(self.turn, dtype=np.int32)
+        self.service = np.asarray(self.service, dtype=np.int32)
+        self.slot = np.asarray(self.slot, dtype=np.int32)
+        self.choices = np.asarray(self.choices, dtype=np.int32)
+        self._index = {}
+        return self
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """Number of input tokens of each example."""
+        return np.diff(self.offsets['input_ids'])
+
+    def token_ids(self, name: str, index: int) -> np.ndarray:
+        offsets = self.offsets[name]
+        return self.tokens[name][offsets[index]:offsets[index + 1]]
+
+    def __len__(self):
+        return len(self.turn)
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        turn = self.turn[index]
+        example = {name: self.token_ids(name, index).tolist() for name in self.tokens}
+        example['example_id'] = self.example_ids[turn]
+        example['user_utterance'] = self.user_utterances[turn]
+        example['service'] = self.services[self.service[index]] if self.service[index] >= 0 else None
+        example['slot'] = self.slots[self.slot[index]] if self.slot[index] >= 0 else None
+        example['choices'] = int(self.choices[index])
+        return example
+
+    def save(self, path: Path):
+        for name in self.tokens:
+            np.save(path.joinpath(f"{name}.npy"), self.tokens[name])
+            np.save(path.joinpath(f"{name}_offsets.npy"), self.offsets[name])
+        for name in INDEX_FIELDS:
+            np.save(path.joinpath(f"{name}.npy"), getattr(self, name))
+        with open(path.joinpath("strings.json"), 'w') as f:
+            json.dump({
+                'example_ids': self.example_ids,
+                'user_utterances': self.user_utterances,
+                'services': self.services,
+                'slots': self.slots,
+            }, f)
+
+    @classmethod
+    def load(cls, path: Path, mmap_mode: Optional[str] = 'r') -> Examples:
+        """Loads examples saved with `save`, memory-mapping the arrays by default."""
+        examples = cls()
+        for name in TOKEN_FIELDS:
+            if path.joinpath(f"{name}.npy").exists():
+                examples.tokens[name] = np.load(path.joinpath(f"{name}.npy"), mmap_mode=mmap_mode)
+                examples.offsets[name] = np.load(path.joinpath(f"{name}_offsets.npy"), mmap_mode=mmap_mode)
+        for name in INDEX_FIELDS:
+            setattr(examples, name, np.load(path.joinpath(f"{name}.npy"), mmap_mode=mmap_mode))
+        with open(path.joinpath("strings.json"), 'r') as f:
+            for name, values in json.load(f).items():
+                setattr(examples, name, values)
+        examples._index = {}
+        return examples
@@ -0,0 +1,682 @@
+from __future__ import annotations
+
+import logging
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Evaluated at import time, so builtin generics cannot be used before Python 3.9
+PastKeyValues = Tuple[Tuple[torch.Tensor, ...], ...]
+
+
+@dataclass
+class Generation:
+    """The output of an example, without its context.
+
+    Attributes
+    ----------
+    token_ids:
+        The output tokens, including <EOS> if it was generated.
+    stop_reason:
+        `eos', `max_len' (``max_len`` tokens generated), `repeat' (``repeat_token_tolerance`` reached), `context' (the
+        whole context was truncated), `candidate' (picked by `candidate_scoring`), `gate' (slot predicted inactive
+        without decoding) or `error' (decoding failed).
+    steps:
+        The number of forward passes of the model.
+    """
+    token_ids: list[int]
+    stop_reason: str
+    steps: int
+
+
+def _extend_mask(mask):
+    mask = torch.cat([mask, mask.new_ones((mask.shape[0], 1))], dim=-1)
+    return mask
+
+
+def _map_key_values(past_key_values: PastKeyValues, function) -> PastKeyValues:
+    """Applies `function` to each key and value tensor.
+
+    Recent transformers versions pass Cache objects (e.g. DynamicCache for GPT-2, EncoderDecoderCache for T5) instead
+    of tuples, which are converted to tuples and back so that the model gets the type it returned. A new cache is
+    returned, so the cache passed is not updated in place by the next forward pass.
+    """
+    legacy = past_key_values.to_legacy_cache() if hasattr(past_key_values, 'to_legacy_cache') else past_key_values
+    mapped = tuple(tuple(function(tensor) for tensor in layer) for layer in legacy)
+    if hasattr(past_key_values, 'to_legacy_cache'):
+        return type(past_key_values).from_legacy_cache(mapped)
+    return mapped
+
+
+def _truncate_past_key_values(
+        past_key_values: PastKeyValues,
+        max_len: int = 1024
+):
+    return _map_key_values(past_key_values, lambda tensor: tensor[..., -(max_len - 1):, :])
+
+
+def _select_rows(past_key_values: PastKeyValues, index: torch.Tensor) -> PastKeyValues:
+    return _map_key_values(past_key_values, lambda tensor: tensor.index_select(0, index))
+
+
+def _trim_left_padding(
+        attention_mask: torch.Tensor,
+        past_key_values: PastKeyValues
+) -> tuple[torch.Tensor, PastKeyValues]:
+    # Drop the leading positions which are padding for every row, e.g. after the longest rows finished
+    start = int(attention_mask.any(dim=0).int().argmax())
+    if start == 0:
+        return attention_mask, past_key_values
+    past_key_values = _map_key_values(past_key_values, lambda tensor: tensor[..., start:, :])
+    return attention_mask[:, start:], past_key_values
+
+
+def _expand_rows(past_key_values: PastKeyValues, num_rows: int) -> PastKeyValues:
+    return _map_key_values(past_key_values, lambda tensor: tensor.expand(num_rows, *tensor.shape[1:]))
+
+
+def common_prefix_length(sequences: list[list[int]]) -> int:
+    shortest, longest = min(sequences), max(sequences)
+    for i, (first, last) in enumerate(zip(shortest, longest)):
+        if first != last:
+            return i
+    return len(shortest)
+
+
+def prefix_key_values(model, prefix_ids: list[int], past_key_values: Optional[PastKeyValues] = None,
+                      start: int = 0) -> PastKeyValues:
+    """Computes the key/values of a prefix shared by the examples of a batch.
+
+    If `past_key_values` are given, they hold the first `start` tokens of the prefix and `prefix_ids` are the
+    remaining tokens.
+    """
+    input_ids = torch.tensor([prefix_ids], device=model.device)
+    # Only the key/values are needed, so the LM head is not applied
+    past_key_values = model.transformer(
+        input_ids=input_ids,
+        position_ids=torch.arange(start, start + len(prefix_ids), device=model.device).unsqueeze(0),
+        past_key_values=past_key_values,
+        use_cache=True,
+        return_dict=False
+    )[1]
+    return past_key_values
+
+
+class PrefixCache:
+    """Keeps the key/values of the last prefix shared by a batch for the following batches.
+
+    With the ``context_first`` prompt layout, the context of a turn extends the context of the previous turn of the
+    dialogue, so only the new utterances have to be fed to the model. The cached key/values are cropped to the part
+    common to the new prefix, so when the context window is truncated or a new dialogue starts the prefix is simply
+    computed from scratch.
+    """
+
+    def __init__(self):
+        self.ids: list[int] = []
+        self.past_key_values: Optional[PastKeyValues] = None
+        self.reused_tokens = 0
+        self.computed_tokens = 0
+
+    def key_values(self, model, prefix_ids: list[int]) -> PastKeyValues:
+        reuse = common_prefix_length([self.ids, prefix_ids]) if self.past_key_values is not None else 0
+        past_key_values = None
+        if reuse > 0:
+            past_key_values = _map_key_values(self.past_key_values, lambda tensor: tensor[..., :reuse, :])
+        if reuse < len(prefix_ids):
+            past_key_values = prefix_key_values(model, prefix_ids[reuse:], past_key_values=past_key_values, start=reuse)
+        self.reused_tokens += reuse
+        self.computed_tokens += len(prefix_ids) - reuse
+        self.ids, self.past_key_values = list(prefix_ids), past_key_values
+        return past_key_values
+
+
+class SlotTemplate:
+    """Token ids of the fixed parts of the slot targets, ``requested = true|false <SEP> value =``.
+
+    The target is tokenized for both values of ``requested`` so that the forced tokens are exactly those of the
+    targets the model was trained on: `prefix` is common to both, `choices` maps the first token which differs to the
+    tokens forced after it.
+    """
+
+    def __init__(self, tokenizer, separators: dict[str, str]):
+        targets = {
+            requested: tokenizer(
+                ("requested" + separators["pair"] + requested + separators["default"] + "value" +
+                 separators["pair"]).rstrip()
+            )['input_ids']
+            for requested in ('true', 'false')
+        }
+        length = common_prefix_length(list(targets.values()))
+        self.prefix: list[int] = targets['true'][:length]
+        self.choices: dict[int, list[int]] = {ids[length]: ids[length + 1:] for ids in targets.values()}
+
+
+class VocabularyShortlist:
+    """Restricts the greedy choice of the next token to the tokens an output can hold.
+
+    Outputs are intent or value indices, ``dontcare``, the slot template and <EOS>, which are covered by a fixed
+    output vocabulary, or values copied from the context, so the shortlist of an example is the output vocabulary
+    plus the tokens of its context. The hidden states are only projected onto the shortlisted embeddings.
+
+    Parameters
+    ----------
+    separators:
+        The separators used to build the targets.
+    max_index:
+        Largest index of an intent or categorical value.
+    """
+
+    def __init__(self, tokenizer, separators: dict[str, str], max_index: int):
+        values = [""] + [str(index) for index in range(max_index + 1)]
+        targets = values + [
+            "requested" + separators["pair"] + requested + separators["default"] + "value" + separators["pair"] + value
+            for requested in ('true', 'false') for value in values + ["dontcare"]
+        ]
+        output_ids = {tokenizer.eos_token_id}
+        for target in targets:
+            output_ids.update(tokenizer(target.strip())['input_ids'])
+        self.output_ids = frozenset(output_ids)
+
+    def restrict(self, model, sequences: list[list[int]]) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Returns the ids and output embeddings of the tokens shortlisted for any row of a batch and a mask of the
+        tokens shortlisted for each row."""
+        rows = [self.output_ids.union(sequence) for sequence in sequences]
+        ids = sorted(set().union(*rows))
+        mask = torch.tensor([[token in row for token in ids] for row in rows], device=model.device)
+        ids = torch.tensor(ids, device=model.device)
+        return ids, model.get_output_embeddings().weight.index_select(0, ids), mask
+
+
+def candidate_scoring(model, context_ids: list[int], candidates: list[list[int]],
+                      prefix_cache: Optional[PrefixCache] = None) -> Generation:
+    """Picks the most likely of the candidate targets of an example.
+
+    The candidates are scored in one teacher-forced forward pass which shares the key/values of the context. The
+    context is computed with `prefix_cache` if given, so that examples sharing a context only compute it once.
+
+    Parameters
+    ----------
+    context_ids:
+        The model input, ending with <BOS>.
+    candidates:
+        Token ids of each candidate target, ending with <EOS>.
+
+    Returns
+    -------
+    generation
+        The ids of the most likely candidate.
+    """
+    prefix, last = context_ids[:-1], context_ids[-1]
+    past_key_values = None
+    if prefix:
+        if prefix_cache is not None:
+            past_key_values = prefix_cache.key_values(model, prefix)
+        else:
+            past_key_values = prefix_key_values(model, prefix)
+        past_key_values = _expand_rows(past_key_values, len(candidates))
+    # The logits of the last context token score the first token of the candidate
+    rows = [[last] + candidate for candidate in candidates]
+    width = max(map(len, rows))
+    input_ids = torch.tensor([row + [last] * (width - len(row)) for row in rows], device=model.device)
+    mask = torch.tensor([[1] * len(row) + [0] * (width - len(row)) for row in rows], device=model.device)
+    logits = model(
+        input_ids=input_ids,
+        attention_mask=torch.cat([mask.new_ones((len(rows), len(prefix))), mask], dim=-1),
+        position_ids=torch.arange(len(prefix), len(prefix) + width, device=model.device).expand(len(rows), -1),
+        past_key_values=past_key_values,
+        use_cache=False,
+        return_dict=False
+    )[0]
+    log_probs = torch.log_softmax(logits[:, :-1].float(), dim=-1)
+    log_probs = log_probs.gather(-1, input_ids[:, 1:].unsqueeze(-1)).squeeze(-1)
+    scores = (log_probs * mask[:, 1:]).sum(dim=-1)
+    return Generation(candidates[int(scores.argmax())], 'candidate', 1)
+
+
+def target_log_probs(model, sequences: list[list[int]], target: list[int], pad_token_id: int,
+                     share_prefix: bool = False, prefix_cache: Optional[PrefixCache] = None) -> torch.Tensor:
+    """Log-probability of `target` following each of `sequences` under teacher forcing (GPT-2 only).
+
+    The sequences are left-padded and scored in one forward pass, in which only the hidden states predicting the
+    target are projected onto the vocabulary. If `share_prefix` is set, the key/values of the prefix common to all
+    sequences are computed once, with `prefix_cache` if given.
+    """
+    past_key_values = None
+    prefix_length = 0
+    if share_prefix:
+        # The last token of each sequence predicts the first token of the target, so it must be fed
+        prefix_length = min(common_prefix_length(sequences), min(map(len, sequences)) - 1)
+    if prefix_length > 0:
+        if prefix_cache is not None:
+            past_key_values = prefix_cache.key_values(model, sequences[0][:prefix_length])
+        else:
+            past_key_values = prefix_key_values(model, sequences[0][:prefix_length])
+        past_key_values = _expand_rows(past_key_values, len(sequences))
+    rows = [sequence[prefix_length:] + target for sequence in sequences]
+    width = max(map(len, rows))
+    input_ids = torch.tensor([[pad_token_id] * (width - len(row)) + row for row in rows], device=model.device)
+    attention_mask = torch.tensor([[0] * (width - len(row)) + [1] * len(row) for row in rows], device=model.device)
+    position_ids = prefix_length + (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+    attention_mask = torch.cat([attention_mask.new_ones((len(rows), prefix_length)), attention_mask], dim=-1)
+    hidden_states = model.transformer(
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        position_ids=position_ids,
+        past_key_values=past_key_values,
+        use_cache=False,
+        return_dict=False
+    )[0]
+    logits = model.get_output_embeddings()(hidden_states[:, -len(target) - 1:-1])
+    log_probs = torch.log_softmax(logits.float(), dim=-1)
+    return log_probs.gather(-1, input_ids[:, -len(target):].unsqueeze(-1)).squeeze(-1).sum(dim=-1)
+
+
+def select_examples(batch: dict, indices: list[int]) -> dict:
+    """Returns a batch with the examples of a padded batch at `indices`."""
+    rows = torch.tensor(indices, dtype=torch.long)
+    selected = {key: batch[key].index_select(0, rows) for key in ('input_ids', 'attention_mask')}
+    for key, value in batch.items():
+        if key not in selected:
+            selected[key] = [value[index] for index in indices]
+    return selected
+
+
+def prompt_lookup(sequence: list[int], max_ngram: int = 3, num_tokens: int = 10) -> list[int]:
+    """Proposes the tokens which follow the last earlier occurrence of the final n-gram of `sequence`.
+
+    Values are mostly copied from the dialogue context, so once the first tokens of a value are generated the tokens
+    which follow them in the context are likely to be generated next. The longest n-gram with a match is used.
+    """
+    if num_tokens <= 0:
+        return []
+    for n in range(min(max_ngram, len(sequence) - 1), 0, -1):
+        ngram = sequence[-n:]
+        for start in range(len(sequence) - n - 1, -1, -1):
+            if sequence[start:start + n] == ngram:
+                return sequence[start + n:start + n + num_tokens]
+    return []
+
+
+def example_batch(batch: dict, index: int) -> dict:
+    """Returns a batch with the `index`-th example of a (left or right) padded batch, without padding."""
+    mask = batch['attention_mask'][index].bool()
+    example = {
+        'input_ids': batch['input_ids'][index][mask].unsqueeze(0),
+        'attention_mask': batch['attention_mask'][index][mask].unsqueeze(0),
+    }
+    for key, value in batch.items():
+        if key not in example:
+            example[key] = [value[index]]
+    return example
+
+
+def sequential_generation(args, batch, model, tokenizer) -> Generation:
+    # Run sequence generation for an example without generation api to control number of repeated tokens.
+    # This prevents complete decoding failure due to runtime errors when the model fails to generate <EOS>.
+    eos_id = tokenizer.eos_token_id
+    max_seq_len = args.max_seq_len
+    input_ids = batch['input_ids'].to(model.device)
+    attention_mask = batch['attention_mask'].to(model.device)
+    batch_size = input_ids.size(0)
+    assert batch_size == 1
+    past_key_values = None
+    repeat_token_count = 0
+    warning_emitted = False
+    # The context window slides once max_seq_len is reached, so the output tokens are collected separately
+    output_ids = []
+    stop_reason = 'max_len'
+    for i in range(args.max_len):
+        if past_key_values:
+            input_ids_step = input_ids[:, -1].unsqueeze(-1)
+        else:
+            input_ids_step = input_ids
+        hidden_states, past_key_values = model.transformer(
+            input_ids=input_ids_step,
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=False
+        )[:2]
+
+        # Only the last position predicts the next token, so the LM head is not applied to the whole context
+        next_token_logits = model.get_output_embeddings()(hidden_states[:, -1, :])
+        next_token = torch.argmax(next_token_logits, dim=-1)
+        if input_ids[0][0].item() == tokenizer.bos_token_id:
+            logger.warning(
+                "{}: Truncated entire context, decoding will be aborted...".format(batch["example_id"][0])
+            )
+            stop_reason = 'context'
+            break
+        if i != 0 and next_token[0].item() == input_ids[0][-1].item():
+            # Token repeated
+            repeat_token_count += 1
+        else:
+            repeat_token_count = 0
+        if len(input_ids[0]) < max_seq_len:
+            input_ids = torch.cat([input_ids, next_token.unsqueeze(-1)], dim=-1)
+            attention_mask = _extend_mask(attention_mask)
+        else:
+            if not warning_emitted:
+                logger.warning("{} exceeds maximum sequence length, truncating...".format(batch["example_id"][0]))
+                warning_emitted = True
+            input_ids = torch.cat([input_ids[:, -(max_seq_len - 1):], next_token.unsqueeze(-1)], dim=1)
+            past_key_values = _truncate_past_key_values(past_key_values, max_len=max_seq_len)
+        output_ids.append(next_token[0].item())
+        if next_token[0].item() == eos_id:
+            stop_reason = 'eos'
+            break
+        if repeat_token_count == args.repeat_token_tolerance:
+            logger.warning(
+                f"Could not decode example {batch['example_id']}. "
+                f"Repeated token {tokenizer.decode(next_token)} more than {repeat_token_count} in a row!"
+            )
+            # Parser will warn if there is no <eos> so we leave it out
+            stop_reason = 'repeat'
+            break
+    return Generation(output_ids, stop_reason, i + 1)
+
+
+def seq2seq_generation(args, batch, model, tokenizer) -> list[Generation]:
+    """Greedy decoding of a padded batch with an encoder-decoder model (T5).
+
+    The encoder is run once for the batch and its outputs are reused at every step, the decoder self-attention and
+    cross-attention key/values being cached by the model. Rows are stopped by the same rules as
+    `sequential_generation` (<EOS>, repeated tokens, ``max_len``) and dropped from the batch as soon as they finish.
+
+    Returns
+    -------
+    generations
+        The output of each example, without the decoder start token.
+    """
+    eos_id = tokenizer.eos_token_id
+    input_ids = batch['input_ids'].to(model.device)
+    attention_mask = batch['attention_mask'].to(model.device)
+    batch_size = input_ids.size(0)
+    encoder_hidden_states = model.get_encoder()(
+        input_ids=input_ids, attention_mask=attention_mask, return_dict=False
+    )[0]
+    decoder_input_ids = torch.full(
+        (batch_size, 1), model.config.decoder_start_token_id, dtype=torch.long, device=model.device
+    )
+    outputs = [[] for _ in range(batch_size)]
+    stop_reasons = ['max_len'] * batch_size
+    steps = [0] * batch_size
+    repeat_token_count = [0] * batch_size
+    past_key_values = None
+    # Index in the batch of each row of the tensors passed to the model
+    active = list(range(batch_size))
+    for i in range(args.max_len):
+        logits, past_key_values = model(
+            encoder_outputs=(encoder_hidden_states,),
+            attention_mask=attention_mask,
+            decoder_input_ids=decoder_input_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=False
+        )[:2]
+        next_tokens = torch.argmax(logits[:, -1, :], dim=-1).tolist()
+        keep = []
+        for row, (index, next_token) in enumerate(zip(active, next_tokens)):
+            output = outputs[index]
+            if i != 0 and next_token == output[-1]:
+                # Token repeated
+                repeat_token_count[index] += 1
+            else:
+                repeat_token_count[index] = 0
+            output.append(next_token)
+            steps[index] = i + 1
+            if next_token == eos_id:
+                stop_reasons[index] = 'eos'
+                continue
+            if repeat_token_count[index] == args.repeat_token_tolerance:
+                logger.warning(
+                    f"Could not decode example {batch['example_id'][index]}. "
+                    f"Repeated token {tokenizer.decode([next_token])} more than {repeat_token_count[index]} "
+                    f"in a row!"
+                )
+                stop_reasons[index] = 'repeat'
+                continue
+            keep.append(row)
+        if not keep:
+            break
+        if len(keep) < len(active):
+            rows = torch.tensor(keep, device=model.device)
+            past_key_values = _select_rows(past_key_values, rows)
+            encoder_hidden_states = encoder_hidden_states.index_select(0, rows)
+            attention_mask = attention_mask.index_select(0, rows)
+            active = [active[row] for row in keep]
+        # The key/values of the previous tokens are cached, so only the last token is fed
+        decoder_input_ids = torch.tensor([[outputs[index][-1]] for index in active], device=model.device)
+    return [
+        Generation(output, stop_reason, num_steps)
+        for output, stop_reason, num_steps in zip(outputs, stop_reasons, steps)
+    ]
+
+
+def batch_generation(args, batch, model, tokenizer, share_prefix: bool = False,
+                     prefix_cache: Optional[PrefixCache] = None,
+                     template: Optional[SlotTemplate] = None,
+                     shortlist: Optional[VocabularyShortlist] = None) -> list[Generation]:
+    """Greedy decoding of a padded batch.
+
+    Each row is stopped by the same rules as `sequential_generation` (<EOS>, repeated tokens, ``max_len``) and is
+    dropped from the batch as soon as it finishes. Rows are left-padded and position ids are computed from the
+    attention mask so that padding does not shift the positions of the context. A row which reaches ``max_seq_len``
+    needs the context window to slide, which a batched cache cannot do for a single row, so that example is decoded
+    again with `sequential_generation`. The output is the same as decoding each example with `sequential_generation`
+    up to rounding: in float32 or float16, padding may flip the argmax of nearly tied tokens.
+
+    If `share_prefix` is set, the key/values of the longest prefix common to all rows (e.g., the dialogue context of
+    the examples of a turn with the ``context_first`` prompt layout) are computed once and shared by all rows. Passing
+    a `prefix_cache` reuses the key/values computed for the previous batches (e.g., the previous turns).
+
+    If a slot `template` is given, the fixed tokens of the slot targets are appended to the slot examples without
+    being decoded: the template prefix is fed with the context, ``true``/``false`` is the most likely of the two
+    template choices and the tokens which follow it are fed to the model with the decision in the next step. Only the
+    value is decoded freely.
+
+    If ``speculative_tokens`` is set, up to that many tokens found by `prompt_lookup` are fed after the last token of
+    a row and the model output for all of them is computed in one step. The proposed tokens are accepted up to the
+    first one which differs from the model output, the key/values of the others are masked, so the output is the same
+    as without speculation.
+
+    If a vocabulary `shortlist` is given (GPT-2 only), the hidden states of each row are only projected onto the
+    embeddings of its shortlisted tokens. With ``shortlist_check`` set, the full vocabulary logits are computed too
+    and used instead whenever their argmax differs.
+
+    Returns
+    -------
+    generations
+        The output of each example, as returned by `sequential_generation`. The template tokens are part of it.
+    """
+    eos_id = tokenizer.eos_token_id
+    max_seq_len = args.max_seq_len
+    sequences = [
+        ids[mask.bool()].tolist() for ids, mask in zip(batch['input_ids'], batch['attention_mask'])
+    ]
+    context_lengths = list(map(len, sequences))
+    stop_reasons = ['max_len'] * len(sequences)
+    # Number of forward passes each row took part in
+    steps = [0] * len(sequences)
+    # Rows which still have to choose between the template choices
+    deciding = set()
+    if template is not None:
+        for index, sequence in enumerate(sequences):
+            if batch['slot'][index] is not None and len(sequence) + len(template.prefix) < max_seq_len:
+                sequence.extend(template.prefix)
+                deciding.add(index)
+        choice_ids = torch.tensor(list(template.choices), device=model.device)
+    if shortlist is not None:
+        shortlist_ids, shortlist_weight, shortlist_mask = shortlist.restrict(model, sequences)
+        shortlist_check = args.get('shortlist_check', False)
+        mismatches = 0
+        if deciding:
+            # Template choices are output tokens, so they are shortlisted for every row
+            choice_columns = torch.searchsorted(shortlist_ids, choice_ids)
+    past_key_values = None
+    prefix_length = 0
+    if share_prefix:
+        # Each row needs at least one token after the prefix to compute its first logits
+        prefix_length = min(common_prefix_length(sequences), min(map(len, sequences)) - 1)
+    if prefix_length > 0:
+        if prefix_cache is not None:
+            past_key_values = prefix_cache.key_values(model, sequences[0][:prefix_length])
+        else:
+            past_key_values = prefix_key_values(model, sequences[0][:prefix_length])
+        past_key_values = _expand_rows(past_key_values, len(sequences))
+    suffixes = [sequence[prefix_length:] for sequence in sequences]
+    width = max(map(len, suffixes))
+    input_ids = torch.tensor(
+        [[tokenizer.pad_token_id] * (width - len(suffix)) + suffix for suffix in suffixes], device=model.device
+    )
+    attention_mask = torch.tensor(
+        [[0] * (width - len(suffix)) + [1] * len(suffix) for suffix in suffixes], device=model.device
+    )
+    position_ids = prefix_length + (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+    attention_mask = torch.cat([attention_mask.new_ones((len(sequences), prefix_length)), attention_mask], dim=-1)
+    repeat_token_count = [0] * len(sequences)
+    # Number of tokens chosen by the model for each row
+    generated = [0] * len(sequences)
+    speculative_tokens = args.get('speculative_tokens', 0)
+    # Tokens proposed for each row in the current step, which are verified by the model
+    drafts = {index: [] for index in range(len(sequences))}
+    # Number of trailing columns of the step input whose logits are used
+    width = 1
+    # Index in `sequences` of each row of the tensors passed to the model
+    active = list(range(len(sequences)))
+    truncated = []
+    for i in range(args.max_len):
+        hidden_states, past_key_values = model.transformer(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=False
+        )[:2]
+        # Only the last `width` positions predict tokens, so the LM head is not applied to the whole context in the
+        # first step
+        hidden_states = hidden_states[:, -width:, :]
+        if shortlist is None:
+            logits = model.get_output_embeddings()(hidden_states)
+            predictions = torch.argmax(logits, dim=-1).tolist()
+            if deciding:
+                choices = choice_ids[torch.argmax(logits[:, -1, choice_ids], dim=-1)].tolist()
+        else:
+            logits = torch.nn.functional.linear(hidden_states, shortlist_weight)
+            logits = logits.masked_fill(~shortlist_mask.unsqueeze(1), float('-inf'))
+            predictions = shortlist_ids[torch.argmax(logits, dim=-1)].tolist()
+            if deciding:
+                choices = choice_ids[torch.argmax(logits[:, -1, choice_columns], dim=-1)].tolist()
+            if shortlist_check:
+                full_predictions = torch.argmax(model.get_output_embeddings()(hidden_states), dim=-1).tolist()
+        # Tokens fed to the model in the next step
+        feeds = {}
+        # Number of draft tokens rejected by each row, whose key/values are masked
+        rejected = {}
+        keep = []
+        for row, index in enumerate(active):
+            sequence = sequences[index]
+            if sequence[0] == tokenizer.bos_token_id:
+                logger.warning(
+                    "{}: Truncated entire context, decoding will be aborted...".format(batch["example_id"][index])
+                )
+                stop_reasons[index], steps[index] = 'context', i + 1
+                continue
+            draft = drafts[index]
+            if shortlist is not None and shortlist_check:
+                start = width - len(draft) - 1
+                if predictions[row][start:] != full_predictions[row][start:]:
+                    mismatches += 1
+                    logger.warning(f"{batch['example_id'][index]}: Next token is not in the vocabulary shortlist")
+                    predictions[row] = full_predictions[row]
+            finished = False
+            # The model output following the last fed token and each draft token, processed as in sequential decoding
+            # until it disagrees with the draft
+            for j, next_token in enumerate(predictions[row][width - len(draft) - 1:]):
+                feed = [next_token]
+                if index in deciding:
+                    deciding.remove(index)
+                    next_token = choices[row]
+                    feed = [next_token] + template.choices[next_token]
+                    repeat_token_count[index] = 0
+                elif generated[index] != 0 and next_token == sequence[-1]:
+                    # Token repeated
+                    repeat_token_count[index] += 1
+                else:
+                    repeat_token_count[index] = 0
+                if len(sequence) + len(feed) > max_seq_len:
+                    truncated.append(index)
+                    finished = True
+                    break
+                sequence.extend(feed)
+                generated[index] += 1
+                if next_token == eos_id or generated[index] == args.max_len:
+                    stop_reasons[index] = 'eos' if next_token == eos_id else 'max_len'
+                    finished = True
+                    break
+                if repeat_token_count[index] == args.repeat_token_tolerance:
+                    logger.warning(
+                        f"Could not decode example {batch['example_id'][index]}. "
+                        f"Repeated token {tokenizer.decode([next_token])} more than {repeat_token_count[index]} "
+                        f"in a row!"
+                    )
+                    stop_reasons[index] = 'repeat'
+                    finished = True
+                    break
+                if j == len(draft) or next_token != draft[j]:
+                    break
+            if finished:
+                steps[index] = i + 1
+                continue
+            rejected[row] = len(draft) - j
+            # The last tokens are not in the cache yet, the tokens which follow them earlier in the sequence are
+            # proposed as the continuation
+            drafts[index] = []
+            if speculative_tokens and index not in deciding:
+                drafts[index] = prompt_lookup(
+                    sequence, max_ngram=args.get('speculative_ngram', 3),
+                    num_tokens=min(speculative_tokens, max_seq_len - len(sequence), args.max_len - generated[index])
+                )
+            feeds[index] = feed + drafts[index]
+            keep.append(row)
+        if not keep:
+            break
+        for row, num_rejected in rejected.items():
+            if num_rejected:
+                attention_mask[row, -num_rejected:] = 0
+        if len(keep) < len(active):
+            rows = torch.tensor(keep, device=attention_mask.device)
+            past_key_values = _select_rows(past_key_values, rows)
+            attention_mask, past_key_values = _trim_left_padding(
+                attention_mask.index_select(0, rows), past_key_values
+            )
+            active = [active[row] for row in keep]
+            deciding.intersection_update(active)
+            if shortlist is not None:
+                shortlist_mask = shortlist_mask.index_select(0, rows)
+        # Rows feeding fewer tokens than others are left-padded, the new tokens following the last unmasked token
+        width = max(len(feeds[index]) for index in active)
+        input_ids = torch.tensor(
+            [[tokenizer.pad_token_id] * (width - len(feeds[index])) + feeds[index] for index in active],
+            device=attention_mask.device
+        )
+        step_mask = torch.tensor(
+            [[0] * (width - len(feeds[index])) + [1] * len(feeds[index]) for index in active],
+            device=attention_mask.device
+        )
+        position_ids = attention_mask.sum(dim=-1, keepdim=True) + (step_mask.cumsum(dim=-1) - 1).clamp(min=0)
+        attention_mask = torch.cat([attention_mask, step_mask], dim=-1)
+    if shortlist is not None and shortlist_check:
+        logger.info(f"Vocabulary shortlist: {mismatches} steps differ from full vocabulary decoding")
+    generations = [
+        Generation(sequence[length:], stop_reason, num_steps)
+        for sequence, length, stop_reason, num_steps in zip(sequences, context_lengths, stop_reasons, steps)
+    ]
+    for index in truncated:
+        logger.warning(f"{batch['example_id'][index]} exceeds maximum sequence length, decoding it on its own...")
+        generations[index] = sequential_generation(args, example_batch(batch, index), model, tokenizer)
+    return generations
@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class BeliefStateJournal:
+    """Line-oriented log of the predictions of a decoding run, from which the belief states file is built.
+
+    Each decoded example is appended as one JSON line as soon as its batch is decoded, and the file is synced to disk
+    at most every `fsync_interval` seconds, so an interrupted run only loses the last predictions. A restarted run
+    reads the journal and skips the examples it holds. `finalize` then writes the belief states in the layout
+    ``{dialogue_id: {turn_index: {"utterance": ..., service: {slot or "*intent*": prediction}}}}`` without holding
+    more than one dialogue in memory.
+    """
+
+    def __init__(self, path: Path, fsync_interval: float = 60.0):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self._file = None
+        self._last_sync = time.time()
+
+    @staticmethod
+    def key(example_id: str, service: str, slot: Optional[str]) -> tuple[str, str, Optional[str]]:
+        return example_id, service, slot
+
+    def records(self) -> Iterator[dict]:
+        if not self.path.exists():
+            return
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line is incomplete if the run was interrupted while writing it
+                    logger.warning(f"Ignoring incomplete line in {self.path}")
+
+    def decoded(self) -> set[tuple[str, str, Optional[str]]]:
+        """Keys of the examples already in the journal."""
+        return {self.key(record['example_id'], record['service'], record['slot']) for record in self.records()}
+
+    def append(self, records: list[dict]):
+        if self._file is None:
+            self._drop_incomplete_line()
+            self._file = open(self.path, 'a')
+        self._file.write("".join(json.dumps(record) + "\n" for record in records))
+        self._file.flush()
+        if time.time() - self._last_sync >= self.fsync_interval:
+            os.fsync(self._file.fileno())
+            self._last_sync = time.time()
+
+    def _drop_incomplete_line(self, chunk_size: int = 2 ** 16):
+        # Appending after an incomplete line would corrupt the first new record
+        if not self.path.exists() or self.path.stat().st_size == 0:
+            return
+        with open(self.path, 'rb+') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) == b"\n":
+                return
+            # Search the last complete line backwards from the end, one chunk at a time
+            end = f.tell()
+            while end > 0:
+                start = max(end - chunk_size, 0)
+                f.seek(start)
+                newline = f.read(end - start).rfind(b"\n")
+                if newline >= 0:
+                    f.truncate(start + newline + 1)
+                    return
+                end = start
+            f.truncate(0)
+
+    def close(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+    def _dialogues(self) -> Iterator[tuple[str, dict]]:
+        dialogue_id, belief_states = None, {}
+        for record in self.records():
+            this_dialogue_id, turn_index = record['example_id'].rsplit("_", 1)
+            if this_dialogue_id != dialogue_id:
+                if dialogue_id is not None:
+                    yield dialogue_id, belief_states
+                dialogue_id, belief_states = this_dialogue_id, {}
+            turn = belief_states.setdefault(turn_index, {})
+            turn["utterance"] = record['utterance']
+            key = "*intent*" if record['slot'] is None else record['slot']
+            turn.setdefault(record['service'], {})[key] = record['prediction']
+        if dialogue_id is not None:
+            yield dialogue_id, belief_states
+
+    def _is_contiguous(self) -> bool:
+        # Dialogues are decoded one after the other, so each dialogue is a contiguous block of the journal
+        finished, current = set(), None
+        for record in self.records():
+            dialogue_id = record['example_id'].rsplit("_", 1)[0]
+            if dialogue_id != current:
+                if dialogue_id in finished:
+                    return False
+                finished.add(current)
+                current = dialogue_id
+        return True
+
+    def finalize(self, output_path: Path) -> int:
+        """Writes the belief states, formatted as ``json.dump(belief_states, f, indent=4)`` would.
+
+        Returns
+        -------
+        num_dialogues
+            The number of dialogues written.
+        """
+        self.close()
+        if self._is_contiguous():
+            dialogues = self._dialogues()
+        else:
+            logger.warning(f"Dialogues are interleaved in {self.path}, merging them in memory")
+            merged = {}
+            for dialogue_id, belief_states in self._dialogues():
+                for turn_index, turn in belief_states.items():
+                    merged_turn = merged.setdefault(dialogue_id, {}).setdefault(turn_index, {})
+                    for key, value in turn.items():
+                        if key == "utterance":
+                            merged_turn[key] = value
+                        else:
+                            merged_turn.setdefault(key, {}).update(value)
+            dialogues = iter(merged.items())
+        tmp_path = output_path.with_name(f".{output_path.name}.tmp-{os.getpid()}")
+        num_dialogues = 0
+        with open(tmp_path, 'w') as f:
+            f.write("{")
+            for dialogue_id, belief_states in dialogues:
+                # The entry of the dialogue in the indented dump of the whole dictionary
+                entry = json.dumps({dialogue_id: belief_states}, indent=4)[1:-2]
+                f.write(("," if num_dialogues else "") + entry)
+                num_dialogues += 1
+            f.write("\n}" if num_dialogues else "}")
+        os.replace(tmp_path, output_path)
+        return num_dialogues
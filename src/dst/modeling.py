@@ -0,0 +1,31 @@
+from __future__ import annotations
+
+import torch
+import torch.nn.functional as F
+
+IGNORE_INDEX = -100
+
+
+def sparse_lm_loss(model, input_ids: torch.Tensor, attention_mask: torch.Tensor, labels: torch.Tensor) -> torch.Tensor:
+    """Language modelling loss of a GPT-2 model computed at the labelled positions only.
+
+    Only the target tokens are labelled, so rather than projecting every position onto the vocabulary as
+    ``model(labels=labels)`` does, the hidden states which predict a label are gathered and the LM head and the
+    cross-entropy are applied to those. The loss is the same as the one returned by the model.
+    """
+    hidden_states = model.transformer(input_ids=input_ids, attention_mask=attention_mask, return_dict=False)[0]
+    # Position t predicts the label at t + 1
+    labels = labels[:, 1:]
+    positions = labels != IGNORE_INDEX
+    logits = model.lm_head(hidden_states[:, :-1][positions])
+    return F.cross_entropy(logits.float(), labels[positions])
+
+
+def lm_loss(args, model, batch: dict, device: torch.device) -> torch.Tensor:
+    """Loss of a training batch, computed sparsely for GPT-2 models if ``sparse_loss`` is set."""
+    input_ids = batch['input_ids'].to(device)
+    attention_mask = batch['attention_mask'].to(device)
+    labels = batch['label_ids'].to(device)
+    if args.get('sparse_loss', False) and 'gpt2' in args.model_name_or_path.lower():
+        return sparse_lm_loss(model, input_ids, attention_mask, labels)
+    return model(input_ids=input_ids, attention_mask=attention_mask, labels=labels).loss
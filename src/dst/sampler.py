@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+from typing import Optional
+
+import numpy as np
+import torch
+
+
+def padding_ratio(batches: list[list[int]], lengths: np.ndarray) -> float:
+    """Fraction of the tokens in the padded batches which are pad tokens."""
+    padded, total = 0, 0
+    for batch in batches:
+        batch_lengths = lengths[batch]
+        padded += int(batch_lengths.max()) * len(batch)
+        total += int(batch_lengths.sum())
+    return 1 - total / padded if padded else 0.0
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """Batches examples of similar length together to reduce padding.
+
+    Each epoch the examples are (optionally) shuffled and split into pools of ``bucket_size`` batches. The examples in a
+    pool are sorted by length and cut into batches of ``batch_size`` examples or, if ``max_tokens`` is set, into the
+    largest batches whose padded size does not exceed ``max_tokens``. The batches are then shuffled so that the model
+    does not see them in length order.
+
+    Parameters
+    ----------
+    lengths:
+        Number of tokens of each example.
+    batch_size:
+        Number of examples in a batch. Ignored if `max_tokens` is set.
+    max_tokens:
+        Maximum number of (padded) tokens in a batch.
+    shuffle:
+        Shuffle the examples and the batches. The order is reproducible for a given `seed` and epoch (see
+        `set_epoch`).
+    bucket_size:
+        Number of batches in a pool of examples sorted by length.
+    seed:
+        Seed of the random generator, which is offset by the epoch.
+    num_replicas, rank:
+        For data-parallel training, the batches are split between ``num_replicas`` processes and the sampler only
+        yields those of process ``rank``. All processes must use the same seed.
+    drop_last:
+        Drop the last batches so that all replicas get the same number of batches.
+    """
+
+    def __init__(self, lengths: np.ndarray, batch_size: int, max_tokens: Optional[int] = None, shuffle: bool = True,
+                 bucket_size: int = 100, seed: int = 0, num_replicas: int = 1, rank: int = 0,
+                 drop_last: bool = False):
+        super().__init__(None)
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.drop_last = drop_last
+        self._batches: Optional[tuple[int, list[list[int]]]] = None
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def _split(self, indices: np.ndarray) -> list[list[int]]:
+        if not self.max_tokens:
+            return [indices[i:i + self.batch_size].tolist() for i in range(0, len(indices), self.batch_size)]
+        batches, batch, max_len = [], [], 0
+        for index in indices.tolist():
+            length = int(self.lengths[index])
+            if batch and max(max_len, length) * (len(batch) + 1) > self.max_tokens:
+                batches.append(batch)
+                batch, max_len = [], 0
+            batch.append(index)
+            max_len = max(max_len, length)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def batches(self) -> list[list[int]]:
+        """Returns the batches of the current epoch."""
+        if self._batches is not None and self._batches[0] == self.epoch:
+            return self._batches[1]
+        rng = np.random.default_rng(self.seed + self.epoch)
+        indices = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        pool_size = self.bucket_size * (self.max_tokens or self.batch_size)
+        if self.max_tokens:
+            # Pools should hold about bucket_size batches whatever the length of the examples
+            pool_size = max(1, int(pool_size / max(1.0, float(self.lengths.mean()))))
+        batches = []
+        for start in range(0, len(indices), pool_size):
+            pool = indices[start:start + pool_size]
+            # Stable sort keeps the order reproducible when the data is not shuffled
+            pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+            batches.extend(self._split(pool))
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        if self.num_replicas > 1:
+            if self.drop_last:
+                batches = batches[:len(batches) - len(batches) % self.num_replicas]
+            batches = batches[self.rank::self.num_replicas]
+        self._batches = (self.epoch, batches)
+        return batches
+
+    def baseline_padding_ratio(self) -> float:
+        """Padding ratio of batches of ``batch_size`` examples sampled without length bucketing."""
+        rng = np.random.default_rng(self.seed + self.epoch)
+        indices = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        batches = [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+        return padding_ratio(batches, self.lengths)
+
+    def epoch_padding_ratio(self) -> float:
+        """Padding ratio of the batches of the current epoch (of this replica)."""
+        return padding_ratio(self.batches(), self.lengths)
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def __len__(self):
+        return len(self.batches())
+
+
+class TurnBatchSampler(torch.utils.data.Sampler):
+    """Batches the examples of each dialogue turn together, in dataset order.
+
+    Turns with more than ``batch_size`` examples are split into several batches.
+    """
+
+    def __init__(self, turns: np.ndarray, batch_size: int):
+        super().__init__(None)
+        self.batch_size = batch_size
+        turns = np.asarray(turns)
+        self.boundaries = [0] + (np.flatnonzero(np.diff(turns)) + 1).tolist() + [len(turns)]
+
+    def __iter__(self):
+        for start, end in zip(self.boundaries[:-1], self.boundaries[1:]):
+            for batch_start in range(start, end, self.batch_size):
+                yield list(range(batch_start, min(batch_start + self.batch_size, end)))
+
+    def __len__(self):
+        return sum(
+            -(-(end - start) // self.batch_size) for start, end in zip(self.boundaries[:-1], self.boundaries[1:])
+        )
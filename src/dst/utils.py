@@ -1,8 +1,17 @@
+from __future__ import annotations
+
+import copy
+import json
 import logging
 import os
+import queue
 import random
 import re
+import shutil
+import threading
+import time
 from pathlib import Path
+from typing import Optional
 
 import numpy as np
 import torch
@@ -12,19 +21,20 @@ from transformers import GPT2LMHeadModel, GPT2Tokenizer, T5ForConditionalGenerat
 logger = logging.getLogger(__name__)
 
 
-def set_seed(args):
-    # For reproduction
-    random.seed(args.seed)
-    np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
-    torch.cuda.manual_seed(args.seed)
-    torch.cuda.manual_seed_all(args.seed)
+def set_seed(args, offset: int = 0):
+    # For reproduction. The `offset` (e.g. the rank of the process) gives processes different random streams
+    seed = args.seed + offset
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
     torch.backends.cudnn.deterministic = args.cudnn.enabled
     torch.backends.cudnn.enabled = args.cudnn.deterministic
     torch.backends.cudnn.benchmark = args.cudnn.benchmark
 
 
-def save_checkpoint(args, tokenizer, model, step, optimizer, scheduler):
+def save_checkpoint(args, tokenizer, model, step, optimizer, scheduler, scaler=None):
     ckpt_path = Path(args.train.checkpoint_dir)
     ckpt_path = ckpt_path.joinpath(args.train.experiment_name)
     if not ckpt_path.exists():
@@ -33,36 +43,288 @@ def save_checkpoint(args, tokenizer, model, step, optimizer, scheduler):
     logger.info(f"Save model in {save_path}!")
     tokenizer.save_pretrained(save_path)
     model.save_pretrained(save_path)
+    if args.train.get('flat_weights', False):
+        save_flat_weights(model.state_dict(), Path(save_path))
     OmegaConf.save(args, f"{ckpt_path}/model_config.yaml")
-    torch.save({
+    state = {
         'optimizer_state_dict': optimizer.state_dict(),
-        'scheduler_state_dict': scheduler.state_dict()
-    }, os.path.join(save_path, "checkpoint.pth"))
+        'scheduler_state_dict': scheduler.state_dict() if scheduler is not None else None
+    }
+    if scaler is not None and scaler.is_enabled():
+        state['scaler_state_dict'] = scaler.state_dict()
+    torch.save(state, os.path.join(save_path, "checkpoint.pth"))
+
+
+def _to_cpu(obj, memo: dict):
+    # Copy the tensors of a (nested) state dict to CPU, keeping tensors which share memory (e.g. tied weights) shared
+    if isinstance(obj, torch.Tensor):
+        key = (obj.data_ptr(), obj.dtype, tuple(obj.shape), obj.device)
+        if key not in memo:
+            memo[key] = obj.detach().to('cpu', copy=True)
+        return memo[key]
+    if isinstance(obj, dict):
+        return {key: _to_cpu(value, memo) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(value, memo) for value in obj)
+    return copy.deepcopy(obj)
+
+
+class AsyncCheckpointWriter:
+    """Saves checkpoints from a background thread so that training does not wait for the writes.
+
+    `save` snapshots the model, optimizer, scheduler and scaler states to CPU memory and queues them. At most
+    `max_pending` snapshots wait to be written, `save` blocking when the queue is full so that snapshots do not pile
+    up in memory. A checkpoint is written to a temporary directory which is renamed once complete, so a checkpoint
+    directory is never partially written. `close` must be called to flush the queued checkpoints.
+
+    The checkpoints have the same layout as those written by `save_checkpoint`: the weights are written by
+    ``save_pretrained`` from the snapshot, in the format and sharding of the installed transformers version, and the
+    flat weights are added if ``flat_weights`` is set.
+    """
+
+    def __init__(self, max_pending: int = 1):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._errors: list[BaseException] = []
+        self._thread = threading.Thread(target=self._run, name="checkpoint-writer")
+        self._thread.start()
+
+    def save(self, args, tokenizer, model, step, optimizer, scheduler, scaler=None):
+        if self._errors:
+            raise RuntimeError("Saving a checkpoint failed") from self._errors[0]
+        memo = {}
+        state = {
+            'optimizer_state_dict': _to_cpu(optimizer.state_dict(), memo),
+            'scheduler_state_dict': copy.deepcopy(scheduler.state_dict()) if scheduler is not None else None
+        }
+        if scaler is not None and scaler.is_enabled():
+            state['scaler_state_dict'] = copy.deepcopy(scaler.state_dict())
+        snapshot = {
+            'args': OmegaConf.create(OmegaConf.to_container(args)),
+            'tokenizer': tokenizer,
+            # Only used to call `save_pretrained`, the weights are saved from the snapshot
+            'model': model,
+            'model_state_dict': _to_cpu(model.state_dict(), memo),
+            'state': state,
+            'step': step,
+        }
+        self._queue.put(snapshot)
+
+    def _run(self):
+        while True:
+            snapshot = self._queue.get()
+            if snapshot is None:
+                break
+            try:
+                self._write(**snapshot)
+            except Exception as e:
+                logger.exception(f"Could not save checkpoint {snapshot['step']}")
+                self._errors.append(e)
+
+    @staticmethod
+    def _write(args, tokenizer, model, model_state_dict, state, step):
+        ckpt_path = Path(args.train.checkpoint_dir).joinpath(args.train.experiment_name)
+        ckpt_path.mkdir(exist_ok=True, parents=True)
+        save_path = ckpt_path.joinpath(f"model.{step}")
+        tmp_path = ckpt_path.joinpath(f".model.{step}.tmp-{os.getpid()}")
+        start_time = time.time()
+        try:
+            tokenizer.save_pretrained(str(tmp_path))
+            model.save_pretrained(str(tmp_path), state_dict=model_state_dict)
+            if args.train.get('flat_weights', False):
+                save_flat_weights(model_state_dict, tmp_path)
+            torch.save(state, tmp_path.joinpath("checkpoint.pth"))
+            if save_path.exists():
+                shutil.rmtree(save_path)
+            os.rename(tmp_path, save_path)
+        finally:
+            if tmp_path.exists():
+                shutil.rmtree(tmp_path)
+        tmp_config = ckpt_path.joinpath(f".model_config.yaml.tmp-{os.getpid()}")
+        OmegaConf.save(args, tmp_config)
+        os.replace(tmp_config, ckpt_path.joinpath("model_config.yaml"))
+        logger.info(f"Saved model in {save_path} in {time.time() - start_time:.3f}s")
+
+    def close(self):
+        """Waits for the queued checkpoints to be written."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._errors:
+            raise RuntimeError("Saving a checkpoint failed") from self._errors[0]
+
+
+def set_gradient_checkpointing(model, enabled: bool = True):
+    """Recompute the activations of each layer in the backward pass instead of storing them."""
+    if hasattr(model, 'gradient_checkpointing_enable'):
+        if enabled:
+            model.gradient_checkpointing_enable()
+        else:
+            model.gradient_checkpointing_disable()
+    else:
+        model.config.gradient_checkpointing = enabled
+    # The key/values cache cannot be used with recomputation
+    model.config.use_cache = not enabled
+
+
+FLAT_WEIGHTS = "weights.bin"
+FLAT_WEIGHTS_INDEX = "weights.json"
+
+
+def save_flat_weights(state_dict: dict[str, torch.Tensor], path: Path, alignment: int = 64):
+    """Writes the tensors of a state dict back to back in one file, with a JSON index of their offsets.
 
+    Tensors which share memory (e.g. tied embeddings) are written once, the other names being recorded as aliases.
+    """
+    index, written = {}, {}
+    offset = 0
+    with open(path.joinpath(FLAT_WEIGHTS), 'wb') as f:
+        for name, tensor in state_dict.items():
+            key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape))
+            if key in written:
+                index[name] = {'alias': written[key]}
+                continue
+            written[key] = name
+            # Offsets are aligned so that the tensors can be viewed in place
+            padding = -offset % alignment
+            f.write(b'\0' * padding)
+            offset += padding
+            data = tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy()
+            f.write(memoryview(data))
+            index[name] = {'dtype': str(tensor.dtype).replace('torch.', ''), 'shape': list(tensor.shape),
+                           'offset': offset}
+            offset += data.nbytes
+    with open(path.joinpath(FLAT_WEIGHTS_INDEX), 'w') as f:
+        json.dump(index, f)
 
-def load_model(args, device: torch.device):
+
+def has_flat_weights(path: Path) -> bool:
+    return path.joinpath(FLAT_WEIGHTS_INDEX).exists() and path.joinpath(FLAT_WEIGHTS).exists()
+
+
+def load_flat_weights(model: torch.nn.Module, path: Path) -> torch.nn.Module:
+    """Replaces the parameters and buffers of `model` with tensors memory-mapped from a `save_flat_weights` file.
+
+    No weights are copied: the tensors view a copy-on-write mapping of the file, so pages are read when first used and
+    modifying the weights does not change the file. Shared tensors stay shared.
+    """
+    with open(path.joinpath(FLAT_WEIGHTS_INDEX), 'r') as f:
+        index = json.load(f)
+    buffer = np.memmap(path.joinpath(FLAT_WEIGHTS), dtype=np.uint8, mode='c')
+    tensors = {}
+    for name, entry in index.items():
+        if 'alias' in entry:
+            continue
+        dtype = getattr(torch, entry['dtype'])
+        nbytes = int(np.prod(entry['shape'], dtype=np.int64)) * torch.empty((), dtype=dtype).element_size()
+        data = torch.from_numpy(buffer[entry['offset']:entry['offset'] + nbytes])
+        tensors[name] = data.view(dtype).reshape(entry['shape'])
+    parameters = {}
+    for name, entry in index.items():
+        source = entry.get('alias', name)
+        module_name, _, attribute = name.rpartition('.')
+        module = model
+        for part in filter(None, module_name.split('.')):
+            module = getattr(module, part)
+        current = module._parameters.get(attribute, module._buffers.get(attribute))
+        if current is None:
+            raise KeyError(f"{name} is not a parameter or buffer of {type(model).__name__}")
+        if tuple(current.shape) != tuple(tensors[source].shape):
+            raise ValueError(f"Shape mismatch for {name}: {tuple(current.shape)} vs {tuple(tensors[source].shape)}")
+        if attribute in module._parameters:
+            if source not in parameters:
+                parameters[source] = torch.nn.Parameter(tensors[source], requires_grad=current.requires_grad)
+            module._parameters[attribute] = parameters[source]
+        else:
+            module._buffers[attribute] = tensors[source]
+    return model
+
+
+def _empty_model(model_class, config):
+    # The weights are loaded afterwards, so skip their random initialisation where possible
+    try:
+        from transformers.modeling_utils import no_init_weights
+    except ImportError:
+        return model_class(config).eval()
+    with no_init_weights():
+        return model_class(config).eval()
+
+
+def _load_weights(model: torch.nn.Module, path: Path):
+    """Loads the weights of a ``save_pretrained`` checkpoint into `model`, in whichever format transformers saved
+    them (safetensors or pickle, possibly sharded). Returns the missing and unexpected keys."""
+    from transformers.modeling_utils import load_sharded_checkpoint, load_state_dict
+    from transformers.utils import SAFE_WEIGHTS_INDEX_NAME, SAFE_WEIGHTS_NAME, WEIGHTS_INDEX_NAME, WEIGHTS_NAME
+
+    if path.joinpath(SAFE_WEIGHTS_INDEX_NAME).exists() or path.joinpath(WEIGHTS_INDEX_NAME).exists():
+        return load_sharded_checkpoint(model, path, strict=False)
+    for name in (SAFE_WEIGHTS_NAME, WEIGHTS_NAME):
+        if path.joinpath(name).exists():
+            return model.load_state_dict(load_state_dict(str(path.joinpath(name))), strict=False)
+    raise FileNotFoundError(f"No model weights in {path}")
+
+
+def load_tokenizer(args):
+    if 'gpt2' in args.model_name_or_path.lower():
+        return GPT2Tokenizer.from_pretrained(args.checkpoint)
+    elif 't5' in args.model_name_or_path.lower():
+        return T5Tokenizer.from_pretrained(args.checkpoint)
+    raise ValueError("Unsupported model.")
+
+
+def load_model(args, device: torch.device, model: Optional[torch.nn.Module] = None, tokenizer=None):
+    """Loads the tokenizer and the model of a checkpoint.
+
+    Checkpoints with flat weights (see `save_flat_weights`) are memory-mapped, others are loaded with
+    ``from_pretrained``. If a `model` of the same architecture is given, the weights of the checkpoint are loaded into
+    it instead of creating a new model. Likewise, a `tokenizer` is reused rather than loaded from the checkpoint.
+    """
     ckpt_path = args.checkpoint
     logger.info(f"Load model, tokenizer from {ckpt_path}")
     if 'gpt2' in args.model_name_or_path.lower():
-        tokenizer = GPT2Tokenizer.from_pretrained(ckpt_path)
-        model = GPT2LMHeadModel.from_pretrained(ckpt_path)
+        model_class = GPT2LMHeadModel
     elif 't5' in args.model_name_or_path.lower():
-        tokenizer = T5Tokenizer.from_pretrained(ckpt_path)
-        model = T5ForConditionalGeneration.from_pretrained(ckpt_path)
+        model_class = T5ForConditionalGeneration
     else:
         raise ValueError("Unsupported model.")
+    if tokenizer is None:
+        tokenizer = load_tokenizer(args)
+    if has_flat_weights(Path(ckpt_path)):
+        if model is None:
+            model = _empty_model(model_class, model_class.config_class.from_pretrained(ckpt_path))
+        load_flat_weights(model, Path(ckpt_path))
+    elif model is not None:
+        missing, unexpected = _load_weights(model, Path(ckpt_path))
+        # Tied weights (e.g. the LM head, which shares the input embeddings) are not saved
+        missing = [key for key in missing if key not in (getattr(model, '_tied_weights_keys', None) or [])]
+        if missing or unexpected:
+            raise ValueError(
+                f"{ckpt_path} does not match the model: missing weights {missing}, unexpected weights {unexpected}"
+            )
+    else:
+        model = model_class.from_pretrained(ckpt_path)
+    if args.get('gradient_checkpointing', False):
+        set_gradient_checkpointing(model)
     model.to(device)
     return model.config, tokenizer, model
 
 
-def load_checkpoint(ckpt_path, optimizer, scheduler):
+def load_checkpoint(ckpt_path, optimizer, scheduler, scaler=None):
     checkpoint = torch.load(os.path.join(ckpt_path, "checkpoint.pth"))
     optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
     if scheduler is not None:
         scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
+    if scaler is not None and scaler.is_enabled() and 'scaler_state_dict' in checkpoint:
+        scaler.load_state_dict(checkpoint['scaler_state_dict'])
     return optimizer, scheduler
 
 
+def belief_states_filename(shard_index: int = 0, num_shards: int = 1) -> str:
+    """Name of the file with the belief states decoded for a checkpoint, or for one shard of the test set."""
+    if num_shards > 1:
+        return f"belief_states.shard-{shard_index}-of-{num_shards}.json"
+    return "belief_states.json"
+
+
 def humanise(
         name: str,
         remove_trailing_numbers: bool = False
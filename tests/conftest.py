@@ -1,10 +1,83 @@
 """
-    Dummy conftest.py for dst.
+    Fixtures shared by the tests: a tiny GPT-2 tokenizer built from a byte-level vocabulary, so that no pretrained
+    files are downloaded, and the decoding settings.
 
-    If you don't know what this is for, just leave it empty.
     Read more about conftest.py under:
     - https://docs.pytest.org/en/stable/fixture.html
     - https://docs.pytest.org/en/stable/writing_plugins.html
 """
+import copy
+import json
 
-# import pytest
+import pytest
+
+# A few merges, so that words are split into sub-words as well as bytes
+MERGES = [("Ġ", "t"), ("h", "e"), ("Ġt", "he"), ("i", "n"), ("Ġ", "a"), ("e", "r"), ("a", "i"), ("Ġ", "s")]
+
+
+@pytest.fixture(scope="session")
+def tokenizer(tmp_path_factory):
+    pytest.importorskip("transformers")
+    from transformers import GPT2Tokenizer
+    from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+
+    from src.dst.dataset import SPECIAL_TOKENS
+
+    vocabulary = list(bytes_to_unicode().values()) + ["".join(merge) for merge in MERGES]
+    path = tmp_path_factory.mktemp("tokenizer")
+    with open(path.joinpath("vocab.json"), "w") as f:
+        json.dump({token: index for index, token in enumerate(vocabulary)}, f)
+    with open(path.joinpath("merges.txt"), "w") as f:
+        f.write("#version: 0.2\n" + "".join(f"{first} {second}\n" for first, second in MERGES))
+    tokenizer = GPT2Tokenizer(str(path.joinpath("vocab.json")), str(path.joinpath("merges.txt")))
+    tokenizer.add_special_tokens(copy.deepcopy(SPECIAL_TOKENS))
+    return tokenizer
+
+
+@pytest.fixture
+def decode_args():
+    """Returns decoding settings, with the given values overriding the defaults."""
+    omegaconf = pytest.importorskip("omegaconf")
+
+    def create(**overrides):
+        args = {
+            'model_name_or_path': 'gpt2',
+            'max_seq_len': 128,
+            'max_len': 12,
+            'repeat_token_tolerance': 15,
+            'decode_only': [],
+            'data_size': -1,
+            'cache_dir': '',
+            'verbose': {'disable_display': True},
+        }
+        args.update(overrides)
+        return omegaconf.OmegaConf.create(args)
+
+    return create
+
+
+@pytest.fixture(scope="session")
+def gpt2_model(tokenizer):
+    """A randomly initialised two-layer GPT-2 model with the vocabulary of the `tokenizer` fixture."""
+    torch = pytest.importorskip("torch")
+    from transformers import GPT2Config, GPT2LMHeadModel
+
+    torch.manual_seed(0)
+    config = GPT2Config(vocab_size=len(tokenizer), n_positions=128, n_embd=32, n_layer=2, n_head=2)
+    # Double precision, so that padding does not change the argmax through rounding errors
+    return GPT2LMHeadModel(config).double().eval()
+
+
+@pytest.fixture(scope="session")
+def t5_model(tokenizer):
+    """A randomly initialised two-layer T5 model with the vocabulary of the `tokenizer` fixture."""
+    torch = pytest.importorskip("torch")
+    from transformers import T5Config, T5ForConditionalGeneration
+
+    torch.manual_seed(0)
+    config = T5Config(
+        vocab_size=len(tokenizer), d_model=32, d_kv=8, d_ff=64, num_layers=2, num_heads=2,
+        pad_token_id=tokenizer.pad_token_id, eos_token_id=tokenizer.eos_token_id,
+        decoder_start_token_id=tokenizer.pad_token_id,
+    )
+    return T5ForConditionalGeneration(config).double().eval()
@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+pytest.importorskip("torch")
+
+from src.dst import dataset as dst_dataset  # noqa: E402
+
+
+def turn(system_utterance, user_utterance):
+    # Descriptions and utterances with leading, trailing and repeated spaces
+    return {
+        "system_utterance": system_utterance,
+        "user_utterance": user_utterance,
+        "intent_dict": {
+            "Taxi_1": {"description": "  Intent: Service: taxi : the rides 1: Book : order", "active": "",
+                       "mapping": {"Book": 1}}
+        },
+        "slot_dict": {
+            "Taxi_1": {
+                "destination": {"description": " Non-categorical: Service: taxi Slot: destination : where to",
+                                "requested": False, "value": "", "mapping": {}},
+                "ride_type": {"description": "Categorical: Service: taxi Slot: ride type : kind  1: pool 2: regular",
+                              "requested": False, "value": "", "mapping": {"pool": 1, "regular": 2}},
+            }
+        },
+    }
+
+
+DIALOGUE = [
+    turn("", "  I need a  taxi "),
+    turn(" Where to?", " the airport"),
+    turn("Shared?  ", "in a pool  "),
+]
+
+
+def descriptions(dialogue_turn):
+    yield dialogue_turn["intent_dict"]["Taxi_1"]["description"]
+    for slot in dialogue_turn["slot_dict"]["Taxi_1"].values():
+        yield slot["description"]
+
+
+def full_string_inputs(tokenizer, prompt_layout):
+    # The model inputs as they were created before the context was tokenized incrementally
+    context = ""
+    for dialogue_turn in DIALOGUE:
+        if not dialogue_turn["system_utterance"]:
+            context += f"<USR> {dialogue_turn['user_utterance']} "
+        else:
+            context += f"<SYS> {dialogue_turn['system_utterance']} <USR> {dialogue_turn['user_utterance']} "
+        for description in descriptions(dialogue_turn):
+            if prompt_layout == 'description_first':
+                model_input = description + " " + context
+            else:
+                model_input = context + "<SEP> " + description.strip()
+            yield tokenizer(model_input.strip())['input_ids'] + [tokenizer.bos_token_id]
+
+
+@pytest.mark.parametrize("prompt_layout", ["description_first", "context_first"])
+def test_incremental_tokenization_matches_full_string(tmp_path, tokenizer, decode_args, prompt_layout):
+    data_path = tmp_path.joinpath("test.json")
+    with open(data_path, "w") as f:
+        json.dump({"data": {"1_00000": DIALOGUE}, "separators": {"pair": " = ", "default": " <SEP> "}}, f)
+    args = decode_args(prompt_layout=prompt_layout)
+    dataset = dst_dataset.TestDataset(args, tokenizer, str(data_path), args.data_size)
+    expected = list(full_string_inputs(tokenizer, prompt_layout))
+    assert len(dataset) == len(expected)
+    for index, input_ids in enumerate(expected):
+        assert dataset[index]['input_ids'] == input_ids
@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+pytest.importorskip("absl")
+pytest.importorskip("click")
+pytest.importorskip("omegaconf")
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from click import ClickException  # noqa: E402
+
+from scripts.gate import gate_belief_states, gate_checkpoint  # noqa: E402
+from src.dst.utils import belief_states_filename  # noqa: E402
+
+INACTIVE = "requested = false <SEP> value ="
+
+
+def prediction(text, stop_reason, gate_probability=None):
+    predicted = {'text': text, 'stop_reason': stop_reason}
+    if gate_probability is not None:
+        predicted['gate_probability'] = gate_probability
+    return predicted
+
+
+def decoded_belief_states():
+    return {
+        "1_00000": {
+            "0": {
+                "utterance": "I need a taxi",
+                "Taxi_1": {
+                    "*intent*": prediction("intent = Book", "eos"),
+                    # Decoded, above and below the threshold
+                    "destination": prediction("requested = false <SEP> value = airport", "eos", 0.95),
+                    "ride_type": prediction("requested = true <SEP> value =", "eos", 0.2),
+                    # Skipped by a decoding threshold lower than the simulated one
+                    "fare": prediction(INACTIVE, "gate", 0.6),
+                    "time": prediction(INACTIVE, "gate", 0.9),
+                },
+            }
+        }
+    }
+
+
+def test_gate_belief_states():
+    belief_states = decoded_belief_states()
+    gated, skipped, num_gated, missing = gate_belief_states(belief_states, 0.9, INACTIVE)
+    assert (skipped, num_gated, missing) == (2, 4, 1)
+    turn = gated["1_00000"]["0"]
+    assert turn["utterance"] == "I need a taxi"
+    assert turn["Taxi_1"]["*intent*"] == prediction("intent = Book", "eos")
+    assert turn["Taxi_1"]["destination"] == prediction(INACTIVE, "gate", 0.95)
+    assert turn["Taxi_1"]["ride_type"] == prediction("requested = true <SEP> value =", "eos", 0.2)
+    assert turn["Taxi_1"]["fare"] == prediction(INACTIVE, "gate", 0.6)
+    assert turn["Taxi_1"]["time"] == prediction(INACTIVE, "gate", 0.9)
+    # The input is not modified
+    assert belief_states["1_00000"]["0"]["Taxi_1"]["destination"]["stop_reason"] == "eos"
+
+
+def test_gate_checkpoint_rejects_thresholds_above_the_decoding_one(tmp_path):
+    with open(tmp_path.joinpath(belief_states_filename()), "w") as f:
+        json.dump(decoded_belief_states(), f)
+    tmp_path.joinpath("experiment_config.yaml").write_text("decode:\n  model_name_or_path: gpt2\n")
+    report = gate_checkpoint(tmp_path, [0.5], INACTIVE)
+    assert report[0.5] == {'gated': 4, 'skipped': 3, 'skip_rate': 0.75}
+    # `fare' was skipped when decoding at 0.6
+    with pytest.raises(ClickException):
+        gate_checkpoint(tmp_path, [0.9], INACTIVE)
@@ -0,0 +1,166 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from src.dst.generation import (  # noqa: E402
+    PrefixCache,
+    _expand_rows,
+    _select_rows,
+    _trim_left_padding,
+    batch_generation,
+    example_batch,
+    prompt_lookup,
+    seq2seq_generation,
+    sequential_generation,
+)
+
+CONTEXTS = [
+    "<USR> I need a taxi to the airport <SEP> where to",
+    "<USR> hi <SEP> the rides",
+    "<SYS> Where to? <USR> the station in a pool please <SEP> kind of ride",
+]
+# Dialogue contexts of consecutive turns, followed by each description with the `context_first' prompt layout
+TURN_CONTEXTS = [
+    "<USR> I need a taxi to the airport",
+    "<USR> I need a taxi to the airport <SYS> Shared ride? <USR> yes in a pool",
+]
+DESCRIPTIONS = ["<SEP> where to", "<SEP> the rides", "<SEP> kind of ride"]
+
+
+def left_padded_batch(tokenizer, contexts):
+    sequences = [tokenizer(context)['input_ids'] + [tokenizer.bos_token_id] for context in contexts]
+    width = max(map(len, sequences))
+    return {
+        'input_ids': torch.tensor(
+            [[tokenizer.pad_token_id] * (width - len(sequence)) + sequence for sequence in sequences]
+        ),
+        'attention_mask': torch.tensor([[0] * (width - len(sequence)) + [1] * len(sequence) for sequence in sequences]),
+        'example_id': [f"1_0000{index}" for index in range(len(sequences))],
+        'slot': [None] * len(sequences),
+    }
+
+
+def outputs(generations):
+    return [(generation.token_ids, generation.stop_reason) for generation in generations]
+
+
+def sequential_outputs(args, batch, model, tokenizer):
+    return [
+        sequential_generation(args, example_batch(batch, index), model, tokenizer)
+        for index in range(len(batch['example_id']))
+    ]
+
+
+@torch.no_grad()
+def test_batch_generation_matches_sequential_generation(tokenizer, gpt2_model, decode_args):
+    # The model runs in float64, the only precision in which padding cannot flip the argmax of nearly tied tokens
+    args = decode_args()
+    batch = left_padded_batch(tokenizer, CONTEXTS)
+    expected = sequential_outputs(args, batch, gpt2_model, tokenizer)
+    generations = batch_generation(args, batch, gpt2_model, tokenizer)
+    assert [generation.token_ids for generation in generations] == [generation.token_ids for generation in expected]
+    assert [generation.stop_reason for generation in generations] == [
+        generation.stop_reason for generation in expected
+    ]
+
+
+@torch.no_grad()
+def test_shared_context_matches_unshared_decoding(tokenizer, gpt2_model, decode_args):
+    args = decode_args()
+    for context in TURN_CONTEXTS:
+        batch = left_padded_batch(tokenizer, [f"{context} {description}" for description in DESCRIPTIONS])
+        expected = batch_generation(args, batch, gpt2_model, tokenizer)
+        generations = batch_generation(args, batch, gpt2_model, tokenizer, share_prefix=True)
+        assert outputs(generations) == outputs(expected)
+
+
+@torch.no_grad()
+def test_prefix_cache_matches_unshared_decoding(tokenizer, gpt2_model, decode_args):
+    args = decode_args()
+    prefix_cache = PrefixCache()
+    # The second turn extends the cached context, the last one starts a new dialogue so the cache is cropped
+    for context in [*TURN_CONTEXTS, "<USR> hi there"]:
+        batch = left_padded_batch(tokenizer, [f"{context} {description}" for description in DESCRIPTIONS])
+        expected = batch_generation(args, batch, gpt2_model, tokenizer)
+        generations = batch_generation(args, batch, gpt2_model, tokenizer, share_prefix=True, prefix_cache=prefix_cache)
+        assert outputs(generations) == outputs(expected)
+    assert prefix_cache.reused_tokens > 0
+
+
+@pytest.mark.parametrize("speculative_tokens", [1, 4])
+@torch.no_grad()
+def test_speculative_decoding_does_not_change_the_output(tokenizer, gpt2_model, decode_args, speculative_tokens):
+    batch = left_padded_batch(tokenizer, CONTEXTS)
+    expected = batch_generation(decode_args(), batch, gpt2_model, tokenizer)
+    generations = batch_generation(
+        decode_args(speculative_tokens=speculative_tokens, speculative_ngram=2), batch, gpt2_model, tokenizer
+    )
+    assert [generation.token_ids for generation in generations] == [generation.token_ids for generation in expected]
+    assert [generation.stop_reason for generation in generations] == [
+        generation.stop_reason for generation in expected
+    ]
+
+
+@pytest.mark.parametrize("sequence, max_ngram, num_tokens, expected", [
+    # The longest n-gram with an earlier occurrence is used
+    ([1, 2, 3, 4, 9, 2, 3, 5, 6, 2, 3], 2, 2, [5, 6]),
+    ([1, 2, 3, 4, 9, 2, 3, 5, 6, 2, 3], 1, 2, [5, 6]),
+    ([7, 2, 3, 4, 8, 3], 3, 5, [4, 8, 3]),
+    # The last occurrence of the n-gram is preferred
+    ([5, 1, 5, 2, 5], 1, 1, [2]),
+    ([1, 2, 3], 3, 4, []),
+    ([1, 2, 1], 3, 0, []),
+    ([1], 3, 4, []),
+])
+def test_prompt_lookup(sequence, max_ngram, num_tokens, expected):
+    assert prompt_lookup(sequence, max_ngram=max_ngram, num_tokens=num_tokens) == expected
+
+
+@torch.no_grad()
+def test_seq2seq_generation_matches_generate(tokenizer, t5_model, decode_args):
+    args = decode_args(model_name_or_path='t5-small')
+    # The encoder inputs of T5 are right-padded
+    sequences = [tokenizer(context)['input_ids'] for context in CONTEXTS]
+    width = max(map(len, sequences))
+    batch = {
+        'input_ids': torch.tensor(
+            [sequence + [tokenizer.pad_token_id] * (width - len(sequence)) for sequence in sequences]
+        ),
+        'attention_mask': torch.tensor([[1] * len(sequence) + [0] * (width - len(sequence)) for sequence in sequences]),
+        'example_id': [f"1_0000{index}" for index in range(len(sequences))],
+    }
+    expected = t5_model.generate(
+        input_ids=batch['input_ids'], attention_mask=batch['attention_mask'], do_sample=False, num_beams=1,
+        max_new_tokens=args.max_len,
+    ).tolist()
+    generations = seq2seq_generation(args, batch, t5_model, tokenizer)
+    for generation, output in zip(generations, expected):
+        # Without the decoder start token, and the padding of the rows which finished early
+        output = output[1:]
+        if tokenizer.eos_token_id in output:
+            output = output[:output.index(tokenizer.eos_token_id) + 1]
+        assert generation.token_ids == output
+
+
+@pytest.mark.parametrize("cache_object", [False, True])
+def test_key_value_helpers(cache_object):
+    # Legacy tuples, or the Cache objects returned by recent transformers versions
+    legacy = tuple((torch.randn(3, 2, 5, 4), torch.randn(3, 2, 5, 4)) for _ in range(2))
+    past_key_values = legacy
+    if cache_object:
+        cache_utils = pytest.importorskip("transformers.cache_utils")
+        past_key_values = cache_utils.DynamicCache.from_legacy_cache(legacy)
+
+    def tensors(key_values):
+        assert type(key_values) is type(past_key_values)
+        return key_values.to_legacy_cache() if cache_object else key_values
+
+    selected = tensors(_select_rows(past_key_values, torch.tensor([0, 2])))
+    assert torch.equal(selected[1][0], legacy[1][0][[0, 2]])
+    # The first position is padding for every row
+    attention_mask = torch.tensor([[0, 0, 1, 1, 1], [0, 1, 1, 1, 1], [0, 0, 0, 1, 1]])
+    attention_mask, trimmed = _trim_left_padding(attention_mask, past_key_values)
+    assert attention_mask.shape == (3, 4)
+    assert torch.equal(tensors(trimmed)[0][1], legacy[0][1][..., 1:, :])
+    expanded = tensors(_expand_rows(_select_rows(past_key_values, torch.tensor([1])), 4))
+    assert torch.equal(expanded[0][0], legacy[0][0][[1, 1, 1, 1]])
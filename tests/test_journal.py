@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+from src.dst.journal import BeliefStateJournal
+
+
+def records(num_turns):
+    for turn_index in range(num_turns):
+        for slot in (None, "destination", "ride_type"):
+            yield {
+                'example_id': f"1_00000_{turn_index}", 'utterance': f"turn {turn_index}", 'service': "Taxi_1",
+                'slot': slot, 'prediction': {'text': f"{slot} {turn_index}", 'stop_reason': 'eos', 'steps': 3},
+            }
+
+
+def decode(journal, all_records, batch_size=2):
+    # Appends the records not in the journal yet in batches, as decode.py does
+    decoded = journal.decoded()
+    remaining = [
+        record for record in all_records
+        if journal.key(record['example_id'], record['service'], record['slot']) not in decoded
+    ]
+    for start in range(0, len(remaining), batch_size):
+        journal.append(remaining[start:start + batch_size])
+
+
+@pytest.mark.parametrize("chunk_size", [8, 2 ** 16])
+def test_resume_after_truncated_line(tmp_path, chunk_size, monkeypatch):
+    all_records = list(records(3))
+    expected_path = tmp_path.joinpath("expected.json")
+    journal = BeliefStateJournal(tmp_path.joinpath("expected.jsonl"))
+    decode(journal, all_records)
+    journal.finalize(expected_path)
+
+    # A run interrupted while writing its fifth record
+    path = tmp_path.joinpath("belief_states.jsonl")
+    with open(path, "w") as f:
+        f.write("".join(json.dumps(record) + "\n" for record in all_records[:4]))
+        f.write(json.dumps(all_records[4])[:20])
+    journal = BeliefStateJournal(path)
+    # Small chunks search the last complete line across several reads
+    drop_incomplete_line = journal._drop_incomplete_line
+    monkeypatch.setattr(journal, "_drop_incomplete_line", lambda: drop_incomplete_line(chunk_size=chunk_size))
+    assert len(journal.decoded()) == 4
+    decode(journal, all_records)
+    journal.close()
+
+    keys = [(record['example_id'], record['slot']) for record in journal.records()]
+    assert len(keys) == len(set(keys)) == len(all_records)
+    output_path = tmp_path.joinpath("belief_states.json")
+    journal.finalize(output_path)
+    assert output_path.read_bytes() == expected_path.read_bytes()
@@ -0,0 +1,46 @@
+import pytest
+
+pytest.importorskip("click")
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from scripts.merge import merge_shards  # noqa: E402
+from src.dst.journal import BeliefStateJournal  # noqa: E402
+from src.dst.utils import belief_states_filename  # noqa: E402
+
+
+def records(dialogue_ids):
+    for dialogue_id in dialogue_ids:
+        for turn_index in range(2):
+            example_id = f"{dialogue_id}_0000{turn_index}"
+            yield {
+                'example_id': example_id, 'utterance': f"turn {turn_index} of {dialogue_id}", 'service': "Taxi_1",
+                'slot': None, 'prediction': {'text': "intent = Book", 'stop_reason': 'eos', 'steps': 4},
+            }
+            yield {
+                'example_id': example_id, 'utterance': f"turn {turn_index} of {dialogue_id}", 'service': "Taxi_1",
+                'slot': "destination",
+                'prediction': {'text': "requested = false <SEP> value = the \"airport\"", 'stop_reason': 'eos',
+                               'steps': 9},
+            }
+
+
+def write_belief_states(path, dialogue_ids):
+    # As decode.py does, through a journal
+    journal = BeliefStateJournal(path.with_suffix(".jsonl"))
+    journal.append(list(records(dialogue_ids)))
+    journal.finalize(path)
+
+
+def test_merged_shards_match_unsharded_output(tmp_path):
+    dialogue_ids = ["1_00000", "1_00001", "2_00000"]
+    unsharded_path = tmp_path.joinpath("unsharded", belief_states_filename())
+    unsharded_path.parent.mkdir()
+    write_belief_states(unsharded_path, dialogue_ids)
+    checkpoint_path = tmp_path.joinpath("model.100")
+    checkpoint_path.mkdir()
+    # Shards hold contiguous blocks of dialogues
+    for shard_index, shard_dialogue_ids in enumerate([dialogue_ids[:1], dialogue_ids[1:]]):
+        write_belief_states(checkpoint_path.joinpath(belief_states_filename(shard_index, 2)), shard_dialogue_ids)
+    assert merge_shards(checkpoint_path, num_shards=2)
+    assert checkpoint_path.joinpath(belief_states_filename()).read_bytes() == unsharded_path.read_bytes()
@@ -0,0 +1,25 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from src.dst.modeling import IGNORE_INDEX, sparse_lm_loss  # noqa: E402
+
+
+@torch.no_grad()
+def test_sparse_lm_loss_matches_dense_loss(tokenizer, gpt2_model):
+    # Training examples: the context is not labelled, the target is, and the batch is right-padded
+    examples = [
+        ("<USR> I need a taxi <SEP> where to <BOS>", " the airport <EOS>"),
+        ("<USR> hi <BOS>", " requested = false <SEP> value = <EOS>"),
+    ]
+    rows = []
+    for context, target in examples:
+        context_ids, target_ids = tokenizer(context)['input_ids'], tokenizer(target)['input_ids']
+        rows.append((context_ids + target_ids, [IGNORE_INDEX] * len(context_ids) + target_ids))
+    width = max(len(input_ids) for input_ids, _ in rows)
+    input_ids = torch.tensor([ids + [tokenizer.pad_token_id] * (width - len(ids)) for ids, _ in rows])
+    attention_mask = torch.tensor([[1] * len(ids) + [0] * (width - len(ids)) for ids, _ in rows])
+    labels = torch.tensor([labels + [IGNORE_INDEX] * (width - len(labels)) for _, labels in rows])
+    expected = gpt2_model(input_ids=input_ids, attention_mask=attention_mask, labels=labels).loss
+    loss = sparse_lm_loss(gpt2_model, input_ids, attention_mask, labels)
+    assert torch.allclose(loss, expected.to(loss.dtype))
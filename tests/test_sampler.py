@@ -0,0 +1,13 @@
+import pytest
+
+pytest.importorskip("torch")
+
+from src.dst.sampler import TurnBatchSampler  # noqa: E402
+
+
+def test_turn_batch_sampler():
+    # Turn of each example, in dataset order
+    turns = [0, 0, 0, 1, 1, 2]
+    sampler = TurnBatchSampler(turns, batch_size=2)
+    assert list(sampler) == [[0, 1], [2], [3, 4], [5]]
+    assert len(sampler) == 4